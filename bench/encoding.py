@@ -0,0 +1,143 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# Measurement encoding benchmark for the fact tables.
+# Loads the same synthetic year of MinMaxHistory and AveragesHistory
+# rows into two new databases, one with REAL measurements and one
+# with measurements in tenths stored as scaled integers, and compares
+# file size, bytes per row and insert throughput (one transaction per
+# day and table, as the hourly bulk dumps do).
+#
+# Usage (from the top source directory):
+#    python bench/encoding.py [stations] [without rowid (yes/no)] [dir]
+# ======================================================================
+
+import sys
+import os
+import random
+import sqlite3
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'emadb'))
+
+import schema
+from queryplan import days, YEAR_START
+
+# Value ranges in tenths, in fact table measurement columns order
+# None for the measurements not given in tenths
+TENTHS = (
+   (110, 140),       # voltage
+   (0, 1000),        # wet
+   (0, 1000),        # cloudy
+   (9800, 10400),    # cal_pressure
+   (8800, 9400),     # abs_pressure
+   (0, 300),         # rain
+   (0, 1000),        # irradiation
+   None,             # vis_magnitude
+   None,             # frequency
+   (-100, 400),      # temperature
+   (100, 1000),      # rel_humidity
+   (-150, 200),      # dew_point
+   (0, 500),         # wind_speed
+   None,             # wind_speed10m
+   None,             # wind_direction
+)
+
+
+def measurements(rnd, scaled):
+   '''Synthetic measurements, as produced by the row extractors'''
+   values = []
+   for scale in TENTHS:
+      if scale is None:
+         values.append(None)
+      elif scaled:
+         values.append(rnd.randint(*scale))
+      else:
+         values.append(float(rnd.randint(*scale)) / 10)
+   values[7]  = round(rnd.uniform(16, 22), 2)       # vis_magnitude
+   values[8]  = round(rnd.uniform(1, 10000), 3)     # frequency
+   values[13] = float(rnd.randint(0, 60))           # wind_speed10m
+   values[14] = rnd.randint(0, 359)                 # wind_direction
+   return tuple(values)
+
+
+def load(dbfile, stations, without_rowid, scaled):
+   '''
+   Load one year of data into a new database.
+   Returns the number of rows and the seconds spent inserting them
+   '''
+   if os.path.exists(dbfile):
+      os.remove(dbfile)
+   conn = sqlite3.connect(dbfile)
+   schema.generate(conn, os.path.join(os.path.dirname(__file__), '..', 'config'),
+                   "%d/%m/%Y", YEAR_START, YEAR_START,
+                   without_rowid=without_rowid, scaled=scaled)
+   rnd     = random.Random(1)
+   cursor  = conn.cursor()
+   nrows   = 0
+   elapsed = 0.0
+   for date_id, day in days(1):
+      minmax = [ (date_id, hour*100, station_id, type_id, 1) +
+                 measurements(rnd, scaled) + ("",)
+                 for station_id in range(1, stations+1)
+                 for hour in range(24)
+                 for type_id in (1, 2) ]
+      averages = [ (date_id, (minute//60)*100 + minute%60, station_id, 1) +
+                   measurements(rnd, scaled) + ("",)
+                   for station_id in range(1, stations+1)
+                   for minute in range(0, 1440, 5) ]
+      t0 = time.time()
+      cursor.executemany(
+         "INSERT OR IGNORE INTO MinMaxHistory VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+         minmax)
+      conn.commit()
+      cursor.executemany(
+         "INSERT OR IGNORE INTO AveragesHistory VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+         averages)
+      conn.commit()
+      elapsed += time.time() - t0
+      nrows   += len(minmax) + len(averages)
+   conn.close()
+   return nrows, elapsed
+
+
+if __name__ == "__main__":
+   stations      = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+   without_rowid = len(sys.argv) > 2 and sys.argv[2] == 'yes'
+   directory     = sys.argv[3] if len(sys.argv) > 3 else "."
+
+   print "One year, %d stations, WITHOUT ROWID: %s" % (stations, without_rowid)
+   results = {}
+   for scaled in (False, True):
+      dbfile = os.path.join(directory, "encoding_%s.db" %
+                            ("scaled" if scaled else "real"))
+      nrows, elapsed = load(dbfile, stations, without_rowid, scaled)
+      size = os.path.getsize(dbfile)
+      results[scaled] = (size, elapsed)
+      print "   %-7s %8d rows %10d bytes %6.1f bytes/row %8.0f rows/s" % (
+         "scaled" if scaled else "REAL", nrows, size, float(size)/nrows,
+         nrows/elapsed)
+   print "   scaled/REAL: size %.2f, insert time %.2f" % (
+      float(results[True][0])/results[False][0],
+      results[True][1]/results[False][1])
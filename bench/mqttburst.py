@@ -0,0 +1,211 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# MQTT burst benchmark.
+# A minimal broker stand-in on localhost accepts the subscriber
+# connection and subscription and then publishes, all at once, the
+# hourly minmax and averages dumps of a number of stations, as they
+# arrive at hh:00. The subscriber runs in the server select() loop,
+# as in the service, and the select() wakeups, onMessages() batches
+# and elapsed time to receive the whole burst are measured for
+# several mqtt_batch limits. A limit of 1 reads one packet per
+# wakeup, as before draining the socket.
+#
+# Usage (from the top source directory):
+#    python bench/mqttburst.py [stations] [batch limits, comma separated]
+# ======================================================================
+
+import sys
+import os
+import random
+import socket
+import struct
+import threading
+import time
+import ConfigParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'emadb'))
+
+from server import Server, logToConsole
+from mqttsubscriber import MQTTGenericSubscriber
+from rowextract import sample
+
+import emaproto
+
+# -------------------
+# Broker stand-in
+# -------------------
+
+def remainingLength(n):
+   '''MQTT variable length encoding'''
+   out = ''
+   while True:
+      n, digit = divmod(n, 128)
+      out += chr(digit | (0x80 if n else 0))
+      if not n:
+         return out
+
+def publish(topic, payload):
+   '''QoS 0 PUBLISH packet'''
+   body = struct.pack('!H', len(topic)) + topic + payload
+   return '\x30' + remainingLength(len(body)) + body
+
+def readPacket(conn):
+   '''Read a whole packet, returns (packet type, body)'''
+   header = ord(conn.recv(1))
+   length, shift = 0, 0
+   while True:
+      digit = ord(conn.recv(1))
+      length += (digit & 0x7f) << shift
+      shift  += 7
+      if not digit & 0x80:
+         break
+   body = ''
+   while len(body) < length:
+      body += conn.recv(length - len(body))
+   return header >> 4, body
+
+
+class Broker(threading.Thread):
+   '''
+   Accepts a single client, answers CONNECT and SUBSCRIBE
+   and then publishes a burst of packets
+   '''
+
+   def __init__(self, packets):
+      threading.Thread.__init__(self, name="broker")
+      self.daemon     = True
+      self.packets    = packets
+      self.subscribed = threading.Event()
+      self.go         = threading.Event()
+      self.listener   = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self.listener.bind(('127.0.0.1', 0))
+      self.listener.listen(1)
+      self.port       = self.listener.getsockname()[1]
+
+
+   def run(self):
+      conn, _ = self.listener.accept()
+      kind, _ = readPacket(conn)                  # CONNECT
+      conn.sendall('\x20\x02\x00\x00')            # CONNACK accepted
+      kind, body = readPacket(conn)               # SUBSCRIBE
+      mid, pos, granted = body[0:2], 2, ''
+      while pos < len(body):
+         n = struct.unpack('!H', body[pos:pos+2])[0]
+         pos += 2 + n + 1
+         granted += '\x00'
+      conn.sendall('\x90' + remainingLength(2 + len(granted)) + mid + granted)
+      self.subscribed.set()
+      self.go.wait()
+      conn.sendall(''.join(self.packets))
+      self.go.wait(60)
+      conn.close()
+
+# ----------
+# Subscriber
+# ----------
+
+class Sink(MQTTGenericSubscriber):
+   '''Counts delivered batches and messages'''
+
+   def __init__(self, srv, parser):
+      self.batches  = 0
+      self.messages = 0
+      self.wakeups  = 0
+      MQTTGenericSubscriber.__init__(self, srv, parser)
+
+   def onInput(self):
+      self.wakeups += 1
+      MQTTGenericSubscriber.onInput(self)
+
+   def onMessage(self, msg, tstamp):
+      pass
+
+   def onMessages(self, batch):
+      self.batches  += 1
+      self.messages += len(batch)
+
+
+def burst(stations):
+   '''Hourly minmax and averages dumps of every station'''
+   rnd     = random.Random(1)
+   stamp   = time.strftime(emaproto.STRFTIME)
+   packets = []
+   for i in range(stations):
+      minmax   = '\n'.join(line for _ in range(24) for line in
+                           (sample(rnd, 'm'), sample(rnd, 'M'), stamp))
+      averages = '\n'.join(line for _ in range(288) for line in
+                           (sample(rnd, 't'), stamp))
+      packets.append(publish('EMA/station%d/history/minmax' % i, minmax))
+      packets.append(publish('EMA/station%d/history/average' % i, averages))
+   return packets
+
+
+def run(packets, batch):
+   '''Receive a burst, returns (wakeups, batches, seconds)'''
+   broker = Broker(packets)
+   broker.start()
+   parser = ConfigParser.ConfigParser()
+   parser.add_section("MQTT")
+   for key, value in (
+      ('mqtt_id',     'bench'),
+      ('mqtt_host',   '127.0.0.1'),
+      ('mqtt_port',   str(broker.port)),
+      ('mqtt_period', '60'),
+      ('mqtt_topics', 'EMA/+/history/minmax, EMA/+/history/average'),
+      ('mqtt_log',    'ERROR'),
+      ('mqtt_batch',  str(batch)),
+      ):
+      parser.set("MQTT", key, value)
+   srv  = Server()
+   sink = Sink(srv, parser)
+   sink.connect()
+   while not broker.subscribed.is_set():
+      srv.step(0.1)
+      sink.paho.loop_write()                      # queued SUBSCRIBE
+   sink.wakeups = 0
+   t0 = time.time()
+   broker.go.set()
+   while sink.messages < len(packets):
+      srv.step(1)
+   elapsed = time.time() - t0
+   sink.paho.disconnect()
+   return sink.wakeups, sink.batches, elapsed
+
+
+if __name__ == "__main__":
+   stations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+   limits   = [ int(x) for x in sys.argv[2].split(',') ] \
+              if len(sys.argv) > 2 else [1, 10, 100, 1000]
+
+   logToConsole()
+   packets = burst(stations)
+   size    = sum(len(p) for p in packets)
+   print "Burst of %d stations: %d messages, %d KiB" % (
+      stations, len(packets), size // 1024)
+   for batch in limits:
+      wakeups, batches, elapsed = run(packets, batch)
+      print "   mqtt_batch %5d: %6d wakeups %6d batches %7.3f sec. %8.0f msg/s" % (
+         batch, wakeups, batches, elapsed, len(packets)/elapsed)
@@ -0,0 +1,199 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# Query plan regression benchmark for the fact tables.
+# Builds a synthetic multi-year, multi-station database and runs a
+# catalog of representative queries, with and without the optional
+# station-first indexes. For each query, the EXPLAIN QUERY PLAN output
+# must use the expected index and the median latency must stay within
+# budget. Budgets are given for a desktop PC and can be scaled for 
+# slower machines. Exits with status 1 if any check fails.
+#
+# Usage (from the top source directory):
+#    python bench/queryplan.py [years] [stations] [budget scale] [db file]
+#
+# The database file is reused if it already exists.
+# ======================================================================
+
+import sys
+import os
+import random
+import sqlite3
+import datetime
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'emadb'))
+
+import schema
+
+YEAR_START = 2015
+
+MEAS = 15                       # measurement columns in fact tables
+
+# (name, SQL, parameters, {station indexes: expected index}, budget ms)
+CATALOG = (
+   ("MinMaxHistory one station, one month",
+    "SELECT * FROM MinMaxHistory WHERE station_id = ? AND date_id BETWEEN ? AND ?",
+    (3, 20150601, 20150630),
+    {False: "sqlite_autoindex_MinMaxHistory_1",
+     True:  "MinMaxHistory_station_idx"},
+    20),
+   ("MinMaxHistory one station, last sample",
+    "SELECT * FROM MinMaxHistory WHERE station_id = ? ORDER BY date_id DESC, time_id DESC LIMIT 1",
+    (3,),
+    {False: "sqlite_autoindex_MinMaxHistory_1",
+     True:  "MinMaxHistory_station_idx"},
+    5),
+   ("MinMaxHistory one station, days with data",
+    "SELECT DISTINCT date_id FROM MinMaxHistory WHERE station_id = ?",
+    (3,),
+    {False: "sqlite_autoindex_MinMaxHistory_1",
+     True:  "COVERING INDEX MinMaxHistory_station_idx"},
+    50),
+   ("MinMaxHistory all stations, one day",
+    "SELECT station_id, max(temperature) FROM MinMaxHistory WHERE date_id = ? GROUP BY station_id",
+    (20150615,),
+    {False: "sqlite_autoindex_MinMaxHistory_1",
+     True:  "sqlite_autoindex_MinMaxHistory_1"},
+    5),
+   ("AveragesHistory one station, one week",
+    "SELECT * FROM AveragesHistory WHERE station_id = ? AND date_id BETWEEN ? AND ?",
+    (3, 20150601, 20150607),
+    {False: "sqlite_autoindex_AveragesHistory_1",
+     True:  "AveragesHistory_station_idx"},
+    30),
+   ("AveragesHistory one station, daily means",
+    "SELECT date_id, avg(temperature) FROM AveragesHistory WHERE station_id = ? AND date_id BETWEEN ? AND ? GROUP BY date_id",
+    (3, 20150101, 20151231),
+    {False: "sqlite_autoindex_AveragesHistory_1",
+     True:  "AveragesHistory_station_idx"},
+    400),
+   ("AveragesHistory samples per station, one day",
+    "SELECT station_id, count(*) FROM AveragesHistory WHERE date_id = ? GROUP BY station_id",
+    (20150615,),
+    {False: "sqlite_autoindex_AveragesHistory_1",
+     True:  "sqlite_autoindex_AveragesHistory_1"},
+    5),
+   ("RealTimeSamples one station, last hour",
+    "SELECT * FROM RealTimeSamples WHERE station_id = ? AND date_id = ? AND time_id >= ?",
+    (3, 20150615, 2300),
+    {False: "sqlite_autoindex_RealTimeSamples_1",
+     True:  "RealTimeSamples_station_idx"},
+    5),
+)
+
+
+def row(rnd, *keys):
+   '''Synthetic fact row: keys, units_id, measurements and timestamp'''
+   return keys + (1,) + tuple(round(rnd.uniform(0, 100), 1)
+                             for i in range(MEAS)) + ("",)
+
+
+def days(years):
+   '''Generates (date_id, date) for each day in the given years'''
+   day  = datetime.date(YEAR_START, 1, 1)
+   end  = datetime.date(YEAR_START + years, 1, 1)
+   while day < end:
+      yield day.year*10000 + day.month*100 + day.day, day
+      day += datetime.timedelta(days=1)
+
+
+def populate(conn, years, stations):
+   '''Fill fact tables with synthetic data from all stations'''
+   rnd = random.Random(1)
+   cursor = conn.cursor()
+   for date_id, day in days(years):
+      cursor.executemany(
+         "INSERT INTO MinMaxHistory VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+         [ row(rnd, date_id, hour*100, station_id, type_id)
+           for hour in range(24)
+           for station_id in range(1, stations+1)
+           for type_id in (2, 3) ])
+      cursor.executemany(
+         "INSERT INTO AveragesHistory VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+         [ row(rnd, date_id, (minute//60)*100 + minute%60, station_id)
+           for minute in range(0, 1440, 5)
+           for station_id in range(1, stations+1) ])
+      if day.month == 6 and day.day == 15:
+         cursor.executemany(
+            "INSERT INTO RealTimeSamples VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            [ row(rnd, date_id, (minute//60)*100 + minute%60, station_id, 1)
+              for minute in range(1440)
+              for station_id in range(1, stations+1) ])
+      conn.commit()
+
+
+def plan(conn, sql, params):
+   '''Returns the EXPLAIN QUERY PLAN details as a single string'''
+   return '; '.join(str(r[-1]) for r in
+                    conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+
+def latency(conn, sql, params, repeat=7):
+   '''Median query latency in milliseconds'''
+   timer = timeit.Timer(lambda: conn.execute(sql, params).fetchall())
+   return 1000*sorted(timer.repeat(repeat, 1))[repeat//2]
+
+
+def check(conn, indexes, scale):
+   '''Run the query catalog. Returns the number of failed checks'''
+   failed = 0
+   print "station indexes: %s" % indexes
+   for name, sql, params, expected, budget in CATALOG:
+      detail = plan(conn, sql, params)
+      ms     = latency(conn, sql, params)
+      ok_plan = expected[indexes] in detail
+      ok_time = ms <= budget*scale
+      failed += (not ok_plan) + (not ok_time)
+      print "   %-4s %8.2f ms  %-48s %s" % (
+         "ok" if ok_plan and ok_time else "FAIL", ms, name, detail)
+   return failed
+
+
+if __name__ == "__main__":
+   years    = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+   stations = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+   scale    = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+   dbfile   = sys.argv[4] if len(sys.argv) > 4 else "queryplan.db"
+   json_dir = os.path.join(os.path.dirname(__file__), '..', 'config')
+
+   exists = os.path.exists(dbfile)
+   conn = sqlite3.connect(dbfile)
+   schema.generate(conn, json_dir, "%d/%m/%Y", YEAR_START,
+                   YEAR_START + years - 1)
+   if not exists:
+      print "Populating %s: %d years, %d stations" % (dbfile, years, stations)
+      populate(conn, years, stations)
+   for table in ('MinMaxHistory', 'AveragesHistory', 'RealTimeSamples'):
+      print "%s: %d rows" % (table,
+            conn.execute("SELECT count(*) FROM %s" % table).fetchone()[0])
+
+   failed = 0
+   for indexes in (False, True):
+      schema.generate(conn, json_dir, "%d/%m/%Y", YEAR_START,
+                      YEAR_START + years - 1, station_indexes=indexes)
+      failed += check(conn, indexes, scale)
+   conn.close()
+   print "%d checks failed" % failed
+   sys.exit(1 if failed else 0)
@@ -0,0 +1,132 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# Row extraction benchmark.
+# Compares the per-field xt*() functions against the generated single
+# pass row extractors and a columnar batch decoder, which slices and
+# converts each field once for the whole list of lines.
+#
+# Usage (from the top source directory):
+#    python bench/rowextract.py [number of lines] [repetitions]
+# ======================================================================
+
+import sys
+import os
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'emadb'))
+
+import dbwritter
+import emaproto
+
+from dbwritter import RLY_OPEN, RLY_CLOSED
+
+def sample(rnd, msgtype):
+   '''Synthetic status message'''
+   line = [' ']*emaproto.SMTE + [')']
+   line[0] = '('
+   def put(begin, end, text):
+      line[begin:end] = list(text)
+   for name, begin, end, scale in emaproto.STATUS_LAYOUT:
+      width = end - begin
+      if name == 'roof_relay':
+         put(begin, end, rnd.choice('CA'))
+      elif name == 'aux_relay':
+         put(begin, end, rnd.choice('EeA'))
+      elif name == 'msg_type':
+         put(begin, end, msgtype)
+      elif scale == emaproto.FREQ:
+         put(begin, end, emaproto.encodeFreq(rnd.uniform(0.1, 5000)))
+      else:
+         put(begin, end, "%0*d" % (width, rnd.randint(0, 10**(width-1))))
+   return ''.join(line)
+
+
+RELAY = {
+   (RLY_CLOSED,RLY_CLOSED): 0,
+   (RLY_OPEN,RLY_CLOSED):   1,
+   (RLY_CLOSED,RLY_OPEN):   2,
+   (RLY_OPEN,RLY_OPEN):     3,
+}
+TYPES = { emaproto.MTMIN: 1, emaproto.MTMAX: 2 }
+
+def perField(lines):
+   d = dbwritter
+   return [ (
+      20150101, 1200, 1,
+      TYPES.get(m[d.SMTB:d.SMTE], -1),
+      RELAY.get((d.xtRoofRelay(m), d.xtAuxRelay(m)), -1),
+      d.xtVoltage(m),
+      d.xtWetLevel(m),
+      d.xtCloudLevel(m),
+      d.xtCalPressure(m),
+      d.xtAbsPressure(m),
+      d.xtRain(m),
+      d.xtIrradiation(m),
+      d.xtMagVisual(m),
+      d.xtFrequency(m),
+      d.xtTemperature(m),
+      d.xtHumidity(m),
+      d.xtDewPoint(m),
+      d.xtWindSpeed(m),
+      d.xtWindSpeed10m(m),
+      d.xtWindDirection(m),
+      '2015-01-01 12:00:00',
+   ) for m in lines ]
+
+def extractor(lines):
+   row = dbwritter.rowExtractor('MinMaxHistory', 
+                                dbwritter.RelayCache(RELAY), TYPES)
+   return [ row(20150101, 1200, 1, None, '2015-01-01 12:00:00', m) 
+            for m in lines ]
+
+def batch(lines):
+   col = emaproto.decodeStatusBatch(lines)
+   n = len(lines)
+   return zip(
+      [20150101]*n, [1200]*n, [1]*n,
+      [ TYPES.get(t, -1) for t in col['msg_type'] ],
+      [ RELAY.get(dbwritter.xtRelays(r, a), -1) 
+        for r, a in zip(col['roof_relay'], col['aux_relay']) ],
+      *([ col[name] for name in dbwritter.MEAS_COLUMNS ] + 
+        [['2015-01-01 12:00:00']*n])
+   )
+
+
+if __name__ == '__main__':
+   n      = int(sys.argv[1]) if len(sys.argv) > 1 else 48
+   repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+   rnd    = random.Random(1)
+   lines  = [ sample(rnd, rnd.choice('mM')) for i in range(n) ]
+   reference = perField(lines)
+   assert extractor(lines) == reference, "extractor rows differ"
+   assert batch(lines) == reference, "batch rows differ"
+   print "%d lines x %d repetitions" % (n, repeat)
+   base = None
+   for func in (perField, extractor, batch):
+      t = timeit.timeit(lambda: func(lines), number=repeat)
+      base = base or t
+      print "%-10s %8.3f s  %6.2f us/line  x%.2f" % (func.__name__, t, 
+                                                    1e6*t/(n*repeat), base/t)
@@ -34,6 +34,15 @@ import os
 import datetime
 import operator
 import math
+import itertools
+import time
+import threading
+import Queue
+import collections
+import multiprocessing
+import signal
+import calendar
+import gzip
 
 from server import Lazy, Server
 
@@ -60,12 +69,35 @@ from emaproto  import SPSB, SPSE
 # Message Types
 from emaproto  import SMTB, SMTE, MTCUR, MTHIS, MTISO, MTMIN, MTMAX
 
-from emaproto import STRFTIME, magnitude, decodeFreq
+from emaproto import STRFTIME, LAG, FREQ, INT
+from emaproto import magnitude, decodeFreq, statusLayout
+from emaproto import encodeStatusBlock, decodeStatusBlock
 
 log = logging.getLogger('dbwritter')
 
 DATABASE_LOCKED = "database is locked"
 
+# Attached partitions database and file names
+PARTITION_RE      = re.compile(r'^rts_(\d{8})$')
+PARTITION_FILE_RE = re.compile(r'^RealTimeSamples_(\d{8})\.db$')
+
+# Backup snapshot file names: <database name>-YYYYMMDD-HHMMSS.<db|sql.gz>
+BACKUP_FILE_RE    = r'^%s-(\d{8}-\d{6})\.(db|db\.gz|sql\.gz)$'
+BACKUP_TIME_FMT   = "%Y%m%d-%H%M%S"
+# First SQLite version with VACUUM INTO
+VACUUM_INTO       = (3, 27, 0)
+
+# Allowed values for the performance related SQLite pragmas
+SQLITE_PRAGMAS = {
+   'journal_mode':       re.compile(r'^(DELETE|TRUNCATE|PERSIST|MEMORY|WAL|OFF)$', re.I),
+   'synchronous':        re.compile(r'^(OFF|NORMAL|FULL|EXTRA|[0-3])$', re.I),
+   'cache_size':         re.compile(r'^-?\d+$'),
+   'mmap_size':          re.compile(r'^\d+$'),
+   'temp_store':         re.compile(r'^(DEFAULT|FILE|MEMORY|[0-2])$', re.I),
+   'busy_timeout':       re.compile(r'^\d+$'),
+   'wal_autocheckpoint': re.compile(r'^-?\d+$'),
+}
+
 UNKNOWN_STATION_ID = -1
 UNKNOWN_MEAS_ID    = -1
 UNKNOWN_UNITS_ID   = -1
@@ -82,6 +114,10 @@ TYP_AVER    = "Averages"
 RLY_OPEN   = 'Open'
 RLY_CLOSED = 'Closed'
 
+ONE_DAY = datetime.timedelta(days=1)
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
 # ===============================
 # Extract and Transform Functions
 # ===============================
@@ -96,9 +132,101 @@ def roundDateTime(ts):
 
 def xtDateTime(tstamp):
    '''Extract and transform Date & Time from (HH:MM:SS DD/MM/YYYY)'''
-   ts = datetime.datetime.strptime(tstamp, STRFTIME) 
+   try:
+      hour, minute, second, date = parseTimestamp(tstamp)
+      ts = datetime.datetime(date[3].year, date[3].month, date[3].day, 
+                             hour, minute, second)
+   except (ValueError, IndexError):
+      ts = datetime.datetime.strptime(tstamp, STRFTIME) 
    return roundDateTime(ts)
 
+# Memoized DD/MM/YYYY dates, a bulk dump repeats only one or two dates
+DATE_MEMO_SIZE = 1024
+dateMemo = {}
+
+def xtDate(text):
+   '''
+   Extract and transform a DD/MM/YYYY date.
+   Returns a memoized tuple of (date_id, next day date_id, 
+   'YYYY-MM-DD' string, datetime.date object, seconds since epoch)
+   '''
+   try:
+      return dateMemo[text]
+   except KeyError:
+      pass
+   if (len(text) != 10 or text[2] != '/' or text[5] != '/' or 
+       not (text[0:2] + text[3:5] + text[6:10]).isdigit()):
+      raise ValueError("Bad date %s" % text)
+   date = datetime.date(int(text[6:10]), int(text[3:5]), int(text[0:2]))
+   nxt  = date + ONE_DAY
+   value = (
+      date.year*10000 + date.month*100 + date.day,
+      nxt.year*10000  + nxt.month*100  + nxt.day,
+      str(date),
+      date,
+      (date.toordinal() - EPOCH_ORDINAL)*86400,
+   )
+   if len(dateMemo) >= DATE_MEMO_SIZE:
+      dateMemo.clear()
+   dateMemo[text] = value
+   return value
+
+def parseTimestamp(tstamp):
+   '''
+   Parse a fixed width (HH:MM:SS DD/MM/YYYY) timestamp without strptime().
+   Returns hour, minute, second and the memoized xtDate() tuple.
+   Raises ValueError on anything but plain digits within the bounds
+   that strptime() and datetime accept.
+   '''
+   if (tstamp[0] != '(' or tstamp[3] != ':' or tstamp[6] != ':' or 
+       tstamp[9] != ' ' or tstamp[20:] != ')' or
+       not (tstamp[1:3] + tstamp[4:6] + tstamp[7:9]).isdigit()):
+      raise ValueError("Bad timestamp %s" % tstamp)
+   hour, minute, second = int(tstamp[1:3]), int(tstamp[4:6]), int(tstamp[7:9])
+   if hour > 23 or minute > 59 or second > 59:
+      raise ValueError("Bad timestamp %s" % tstamp)
+   return hour, minute, second, xtDate(tstamp[10:20])
+
+def xtTimestamp(tstamp, epoch=False):
+   '''
+   Extract and transform Date & Time from (HH:MM:SS DD/MM/YYYY)
+   using integer arithmetic only.
+   Returns date_id and time_id rounded to the nearest minute
+   and the 'YYYY-MM-DD HH:MM:SS' timestamp string, or the
+   seconds since epoch if epoch is True.
+   '''
+   try:
+      hour, minute, second, date = parseTimestamp(tstamp)
+   except (ValueError, IndexError):
+      # Non standard width, let strptime() decide
+      date_id, time_id, ts = xtDateTime(tstamp)
+      if epoch:
+         return date_id, time_id, calendar.timegm(ts.timetuple())
+      return date_id, time_id, ts.strftime("%Y-%m-%d %H:%M:%S")
+   date_id  = date[0]
+   seconds  = hour*3600 + minute*60 + second
+   if epoch:
+      ts = date[4] + seconds
+   else:
+      ts = date[2] + ' ' + tstamp[1:9]
+   seconds += 30
+   if seconds >= 86400:
+      date_id  = date[1]
+      seconds -= 86400
+   minutes = seconds // 60
+   return (date_id, 
+           (minutes // 60)*100 + minutes % 60, 
+           ts)
+
+def tsText(tstamp):
+   '''
+   'YYYY-MM-DD HH:MM:SS' string of a timestamp given either 
+   as such or as seconds since epoch
+   '''
+   if isinstance(tstamp, basestring):
+      return tstamp
+   return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(tstamp))
+
 def xtMeasType(message):
    '''Extract and transform Measurement Type'''
    t =  message[SMTB:SMTE]
@@ -123,6 +251,11 @@ def xtAuxRelay(message):
    c = message[SARB]
    return RLY_OPEN if c == 'E' or c == 'e' else RLY_CLOSED
 
+def xtRelays(roof, aux):
+   '''Transform Roof and Aux Relay status characters'''
+   return (RLY_CLOSED if roof == 'C' else RLY_OPEN,
+           RLY_OPEN if aux == 'E' or aux == 'e' else RLY_CLOSED)
+
 def xtVoltage(message):
    '''Extract and transform Voltage'''
    return float(message[SPSB:SPSE]) / 10
@@ -184,6 +317,241 @@ def xtWindDirection(message):
    return int(message[SWDB:SWDE])
 
 
+# ======================
+# Row Extractors Factory
+# ======================
+
+# Measurement columns, in fact table order
+MEAS_COLUMNS = (
+   'voltage',
+   'wet',
+   'cloudy',
+   'cal_pressure',
+   'abs_pressure',
+   'rain',
+   'irradiation',
+   'vis_magnitude',
+   'frequency',
+   'temperature',
+   'rel_humidity',
+   'dew_point',
+   'wind_speed',
+   'wind_speed10m',
+   'wind_direction',
+)
+
+# Key columns in front of the measurements, per fact table
+# 'type_id' is taken from the argument except for MinMaxHistory,
+# where it comes from the message type character
+KEY_COLUMNS = {
+   'MinMaxHistory':   ('date_id', 'time_id', 'station_id', 'msg_type', 
+                       'units_id'),
+   'AveragesHistory': ('date_id', 'time_id', 'station_id', 'units_id'),
+   'RealTimeSamples': ('date_id', 'time_id', 'station_id', 'type_id', 
+                       'units_id'),
+}
+
+ROW_TEMPLATE = '''
+def make(relay, types):
+   def row(date_id, time_id, station_id, type_id, tstamp, m):
+      f = int(m[%(mant)s]) * pow(10, int(m[%(exp)s]) - 3)
+      return (%(values)s,
+         tstamp,
+      )
+   return row
+'''
+
+# Compiled extractor makers, keyed by (table, lag, scaled)
+extractors = {}
+
+class RelayCache(dict):
+   '''units_id cache keyed by the raw roof and aux relay characters'''
+
+   def __init__(self, units):
+      dict.__init__(self)
+      self.__units = units
+
+   def __missing__(self, key):
+      value = self.__units.get(xtRelays(key[0], key[1]), -1)
+      self[key] = value
+      return value
+
+
+def rowExtractor(table, relay, types, lag=LAG, scaled=False):
+   '''
+   Returns a specialised single pass row extractor for a fact table
+   and protocol lag, generated from the emaproto status layout.
+   relay is a RelayCache and types a dictionary from message type
+   characters to type_id (only used by MinMaxHistory).
+   If scaled, measurements in tenths are kept as integers.
+   The returned function signature is 
+   row(date_id, time_id, station_id, type_id, tstamp, message)
+   and returns the complete tuple to be inserted.
+   '''
+   key = (table, lag, scaled)
+   if key not in extractors:
+      extractors[key] = compileExtractor(table, lag, scaled)
+   return extractors[key](relay, types)
+
+
+def compileExtractor(table, lag, scaled):
+   '''Generates and compiles the extractor code for a table and lag'''
+   layout = dict( (name, (begin, end, scale)) 
+                  for name, begin, end, scale in statusLayout(lag) )
+   values = []
+   for name in KEY_COLUMNS[table]:
+      if name == 'msg_type':
+         values.append("types.get(m[%d:%d], -1)" % layout[name][0:2])
+      elif name == 'units_id':
+         values.append("relay[m[%d:%d]]" % (layout['roof_relay'][0], 
+                                            layout['aux_relay'][1]))
+      else:
+         values.append(name)
+   for name in MEAS_COLUMNS:
+      if name == 'vis_magnitude':
+         values.append("magnitude(f)")
+         continue
+      begin, end, scale = layout[name]
+      if scale == FREQ:
+         values.append("f")
+      elif scale == INT or (scaled and scale == 10):
+         values.append("int(m[%d:%d])" % (begin, end))
+      elif scale == 1:
+         values.append("float(m[%d:%d])" % (begin, end))
+      else:
+         values.append("float(m[%d:%d]) / %d" % (begin, end, scale))
+   begin = layout['frequency'][0]
+   source = ROW_TEMPLATE % {
+      'exp'   : "%d" % begin,
+      'mant'  : "%d:%d" % (begin + 1, begin + 5),
+      'values': ",\n         ".join(values),
+   }
+   log.verbose("%s extractor for lag %d:%s", table, lag, source)
+   namespace = { 'pow': math.pow, 'magnitude': magnitude }
+   exec compile(source, "<%s extractor>" % table, 'exec') in namespace
+   return namespace['make']
+
+
+def blockOffset(time_id, tstamp):
+   '''
+   Seconds from the minute time_id to a timestamp, given either as
+   'YYYY-MM-DD HH:MM:SS' string or seconds since epoch. As time_id is 
+   rounded to the nearest minute, offsets range from -30 to 29.
+   '''
+   if isinstance(tstamp, basestring):
+      seconds = (int(tstamp[11:13])*3600 + int(tstamp[14:16])*60 + 
+                 int(tstamp[17:19]))
+   else:
+      seconds = tstamp % 86400
+   offset = seconds - (time_id // 100)*3600 - (time_id % 100)*60
+   return (offset + 43200) % 86400 - 43200
+
+
+def expandBlock(date_id, time_id, station_id, type_id, block):
+   '''
+   Expand a RealTimeBlocks row back into one tuple per sample:
+   (date_id, time_id, station_id, type_id, offset, roof_relay, 
+   aux_relay, measurements in fact table order...)
+   with measurements in their units, as in a REAL encoded table.
+   '''
+   columns = decodeStatusBlock(block)
+   fields  = [ columns[name] for name in 
+               ('offset', 'roof_relay', 'aux_relay') + MEAS_COLUMNS ]
+   return [ (date_id, time_id, station_id, type_id) + values 
+            for values in zip(*fields) ]
+
+
+# =======================
+# Bulk dump parsing stage
+# =======================
+
+def parseDump(table, relay, types, scaled, epoch, station_id, payload):
+   '''
+   Parse an hourly bulk dump into the list of rows to insert into 
+   a fact table. This is a module level function with picklable 
+   arguments only, so that it can also run in a worker process.
+   relay is a units_id dictionary keyed by (roof, aux) relay states.
+   '''
+   extract = rowExtractor(table, RelayCache(relay), types, scaled=scaled)
+   message = payload.split('\n')
+   rows = []
+   if table == 'MinMaxHistory':
+      # minima & maxima lines share the same timestamp line
+      for i in range(0, len(message)/3):
+         date_id, time_id, tstamp = xtTimestamp(message[3*i+2], epoch)
+         rows.append(extract(date_id, time_id, station_id, None, tstamp, 
+                             message[3*i]))
+         rows.append(extract(date_id, time_id, station_id, None, tstamp, 
+                             message[3*i+1]))
+   else:
+      for i in range(0, len(message)/2):
+         date_id, time_id, tstamp = xtTimestamp(message[2*i+1], epoch)
+         rows.append(extract(date_id, time_id, station_id, None, tstamp, 
+                             message[2*i]))
+   return rows
+
+
+def poolInit():
+   '''Worker processes leave signal handling to the server'''
+   signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+
+# ==============
+# Insert Helpers
+# ==============
+
+def isLocked(error):
+   '''True for a database is locked error'''
+   return (isinstance(error, sqlite3.OperationalError) and 
+           error.args[0] == DATABASE_LOCKED)
+
+def notNull(conn, table):
+   '''Positions of the NOT NULL columns of a table'''
+   return tuple(info[0] for info in 
+                conn.execute("PRAGMA main.table_info(%s)" % table) if info[3])
+
+def insertMany(cursor, sql, rows, name, required=()):
+   '''
+   executemany() an INSERT OR IGNORE statement. Rows with a NULL value 
+   in a required (NOT NULL) column, which OR IGNORE would silently skip,
+   are rejected beforehand. Should a row violate a constraint not 
+   covered by the conflict clause, only that row is rejected and the 
+   rows following it are still inserted. Rejected rows are logged, so 
+   the rows ignored by the statement are exactly the duplicates.
+   Returns the number of rows inserted and of rows rejected.
+   '''
+   inserted = 0
+   rejected = 0
+   if required:
+      valid = []
+      for row in rows:
+         if any(row[i] is None for i in required):
+            log.error("%s: row %s rejected: NULL in a NOT NULL column", 
+                      name, row[0:4])
+            rejected += 1
+         else:
+            valid.append(row)
+      rows = valid
+   while rows:
+      counts = []
+      def track(rows):
+         for row in rows:
+            counts.append(cursor.rowcount)   # rows inserted so far
+            yield row
+      try:
+         cursor.executemany(sql, track(rows))
+      except sqlite3.IntegrityError, e:
+         k = len(counts) - 1
+         inserted += max(0, counts[k])
+         rejected += 1
+         log.error("%s: row %s rejected: %s", name, rows[k][0:4], e)
+         rows = rows[k+1:]
+      else:
+         return inserted + cursor.rowcount, rejected
+   return inserted, rejected
+
+
 # ===================
 # MinMaxHistory Class
 # ===================
@@ -199,7 +567,7 @@ class MinMaxHistory(object):
       '''Reconfigures itself after a reload'''
       self.__conn     = conn
       self.__cursor   = self.__conn.cursor()
-      self.__rowcount = self.rowcount()
+      self.__required = notNull(conn, 'MinMaxHistory')
       paren = self.__paren      # shortcut
       # Build units cache
       self.__relay = {
@@ -213,24 +581,32 @@ class MinMaxHistory(object):
          TYP_MIN:  paren.lkType(TYP_MIN),
          TYP_MAX:  paren.lkType(TYP_MAX),
       }      
+      # Build row extractor
+      self.__types = {
+         MTMIN: self.__type[TYP_MIN],
+         MTMAX: self.__type[TYP_MAX],
+      }
+      self.__scaled  = schema.isScaled(conn, 'MinMaxHistory')
+      self.__epoch   = schema.isEpoch(conn, 'MinMaxHistory')
+      self.__extract = rowExtractor('MinMaxHistory', 
+                                    RelayCache(self.__relay), self.__types,
+                                    scaled=self.__scaled)
 
 
-   def rowcount(self):
-      '''Find out the current row count'''
-      self.__cursor.execute("SELECT count(*) FROM MinMaxHistory")
-      return self.__cursor.fetchone()[0]
-
-
-   def insert(self, rows):
+   def insert(self, rows, commit=True):
       '''Update the MinMaxHistory Fact Table'''
       log.debug("MinMaxHistory: updating table")
+      commited   = 0
+      duplicates = 0
+      rejected   = 0
       try:
-         self.__cursor.executemany(
-            "INSERT OR FAIL INTO MinMaxHistory VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", 
-            rows)
-      except sqlite3.IntegrityError, e:
-         log.debug("MinMaxHistory: overlapping rows")  
+         commited, rejected = insertMany(self.__cursor, 
+            "INSERT OR IGNORE INTO MinMaxHistory VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", 
+            rows, "MinMaxHistory", self.__required)
+         duplicates = len(rows) - commited - rejected
       except sqlite3.OperationalError, e:
+         if not commit:
+            raise   # rolled back by the unit of work
          self.__conn.rollback()
          if e.args[0] != DATABASE_LOCKED:
             raise
@@ -241,48 +617,26 @@ class MinMaxHistory(object):
                 )
       except sqlite3.Error, e:
          log.error(e)
-         self.__conn.rollback()
+         if commit:
+            self.__conn.rollback()
          raise
-      self.__conn.commit()   # commit anyway what was really updated
-      rowcount = self.rowcount()
-      commited = rowcount -  self.__rowcount
-      self.__rowcount = rowcount
-      log.info("MinMaxHistory: commited rows (%d/%d)", commited, len(rows))
+      if commit:
+         self.__conn.commit()   # commit anyway what was really updated
+      log.info("MinMaxHistory: commited rows (%d/%d), %d duplicates, %d rejected",
+               commited, len(rows), duplicates, rejected)
       return  commited
 
 
    def row(self, date_id, time_id, station_id, tstamp,  message):
       '''Produces one minmax row to be inserted into the database'''
-
-      # Get values from cache
-      units_id = self.__relay.get((xtRoofRelay(message),xtAuxRelay(message)), -11)
-      type_id  = self.__type.get(xtMeasType(message), -1)
-
-      return (
-         date_id,               # date_id
-         time_id,               # time_id
-         station_id,            # station_id
-         type_id,               # type_id
-         units_id,              # units_id
-         xtVoltage(message),    # voltage
-         xtWetLevel(message),   # wet
-         xtCloudLevel(message), # cloudy
-         xtCalPressure(message),   # cal_pressure
-         xtAbsPressure(message),   # abs_pressure
-         xtRain(message),          # rain
-         xtIrradiation(message),   # irradiation
-         xtMagVisual(message),     # vis_magnitude
-         xtFrequency(message),     # frequency
-         xtTemperature(message),   # temperature
-         xtHumidity(message),      # rel_humidity
-         xtDewPoint(message),      # dew_point
-         xtWindSpeed(message),     # wind_speed
-         xtWindSpeed10m(message),  # wind_speed10m
-         xtWindDirection(message), # wind_direction
-         tstamp,                   # timestamp
-         )
+      return self.__extract(date_id, time_id, station_id, None, tstamp, 
+                            message)
 
 
+   def dumpArgs(self):
+      '''parseDump() arguments to produce minmax rows'''
+      return ('MinMaxHistory', self.__relay, self.__types, self.__scaled, 
+              self.__epoch)
 
 # =====================
 # AveragesHistory Class
@@ -299,7 +653,7 @@ class AveragesHistory(object):
       '''Reconfigures itself after a reload'''
       self.__conn     = conn
       self.__cursor   = self.__conn.cursor()
-      self.__rowcount = self.rowcount()
+      self.__required = notNull(conn, 'AveragesHistory')
       paren = self.__paren      # shortcut
       # Build units cache
       self.__relay = {
@@ -308,24 +662,28 @@ class AveragesHistory(object):
          (RLY_OPEN,RLY_CLOSED):   paren.lkUnits(roof=RLY_OPEN, aux=RLY_CLOSED),
          (RLY_OPEN,RLY_OPEN):     paren.lkUnits(roof=RLY_OPEN, aux=RLY_OPEN),
       }
+      # Build row extractor
+      self.__scaled  = schema.isScaled(conn, 'AveragesHistory')
+      self.__epoch   = schema.isEpoch(conn, 'AveragesHistory')
+      self.__extract = rowExtractor('AveragesHistory', 
+                                    RelayCache(self.__relay), None,
+                                    scaled=self.__scaled)
 
 
-   def rowcount(self):
-      '''Find out the current row count'''
-      self.__cursor.execute("SELECT count(*) FROM AveragesHistory")
-      return self.__cursor.fetchone()[0]
-
-
-   def insert(self, rows):
+   def insert(self, rows, commit=True):
       '''Update the AveragesHistory Fact Table'''
       log.debug("AveragesHistory: updating table")
+      commited   = 0
+      duplicates = 0
+      rejected   = 0
       try:
-         self.__cursor.executemany(
-            "INSERT OR FAIL INTO AveragesHistory VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", 
-            rows)
-      except sqlite3.IntegrityError, e:
-         log.debug("AveragesHistory: overlapping rows")  
+         commited, rejected = insertMany(self.__cursor, 
+            "INSERT OR IGNORE INTO AveragesHistory VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", 
+            rows, "AveragesHistory", self.__required)
+         duplicates = len(rows) - commited - rejected
       except sqlite3.OperationalError, e:
+         if not commit:
+            raise   # rolled back by the unit of work
          self.__conn.rollback()
          if e.args[0] != DATABASE_LOCKED:
             raise
@@ -336,46 +694,26 @@ class AveragesHistory(object):
                 )
       except sqlite3.Error, e:
          log.error(e)
-         self.__conn.rollback()
+         if commit:
+            self.__conn.rollback()
          raise
-      self.__conn.commit()   # commit anyway what was really updated
-      rowcount = self.rowcount()
-      commited = rowcount -  self.__rowcount
-      self.__rowcount = rowcount
-      log.info("AveragesHistory: commited rows (%d/%d)", commited, len(rows))
+      if commit:
+         self.__conn.commit()   # commit anyway what was really updated
+      log.info("AveragesHistory: commited rows (%d/%d), %d duplicates, %d rejected",
+               commited, len(rows), duplicates, rejected)
       return  commited
 
 
    def row(self, date_id, time_id, station_id, tstamp,  message):
       '''Produces one averages history row to be inserted into the database'''
-
-      # Get values from cache
-      units_id = self.__relay.get((xtRoofRelay(message),xtAuxRelay(message)), -11)
-
-      return (
-         date_id,               # date_id
-         time_id,               # time_id
-         station_id,            # station_id
-         units_id,              # units_id
-         xtVoltage(message),    # voltage
-         xtWetLevel(message),   # wet
-         xtCloudLevel(message), # cloudy
-         xtCalPressure(message),   # cal_pressure
-         xtAbsPressure(message),   # abs_pressure
-         xtRain(message),          # rain
-         xtIrradiation(message),   # irradiation
-         xtMagVisual(message),     # vis_magnitude
-         xtFrequency(message),     # frequency
-         xtTemperature(message),   # temperature
-         xtHumidity(message),      # rel_humidity
-         xtDewPoint(message),      # dew_point
-         xtWindSpeed(message),     # wind_speed
-         xtWindSpeed10m(message),  # wind_speed10m
-         xtWindDirection(message), # wind_direction
-         tstamp,                   # timestamp
-         )
+      return self.__extract(date_id, time_id, station_id, None, tstamp, 
+                            message)
 
 
+   def dumpArgs(self):
+      '''parseDump() arguments to produce averages history rows'''
+      return ('AveragesHistory', self.__relay, None, self.__scaled, 
+              self.__epoch)
 
 
 # =====================
@@ -392,7 +730,7 @@ class RealTimeSamples(object):
       '''Reconfigures itself after a reload'''
       self.__conn     = conn
       self.__cursor   = self.__conn.cursor()
-      self.__rowcount = self.rowcount()
+      self.__required = notNull(conn, 'RealTimeSamples')
       paren = self.__paren      # shortcut
       # Build units cache
       self.__relay = {
@@ -406,24 +744,32 @@ class RealTimeSamples(object):
          TYP_SAMPLES: paren.lkType(TYP_SAMPLES),
          TYP_AVER:    paren.lkType(TYP_AVER),
       }      
+      # Timestamps stored as seconds since epoch
+      self.epoch     = schema.isEpoch(conn, 'RealTimeSamples')
+      # Build row extractor
+      self.__extract = rowExtractor('RealTimeSamples', 
+                                    RelayCache(self.__relay), None,
+                                    scaled=schema.isScaled(conn, 
+                                                           'RealTimeSamples'))
 
 
-   def rowcount(self):
-      '''Find out the current row count'''
-      self.__cursor.execute("SELECT count(*) FROM RealTimeSamples")
-      return self.__cursor.fetchone()[0]
-
-
-   def insert(self, rows):
+   def insert(self, rows, commit=True):
       '''Update the RealTimeSamples Fact Table'''
       log.debug("RealTimeSamples: updating table")
+      commited   = 0
+      duplicates = 0
+      rejected   = 0
       try:
-         self.__cursor.executemany(
-            "INSERT OR FAIL INTO RealTimeSamples VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", 
-            rows)
-      except sqlite3.IntegrityError, e:
-         log.warn("RealTimeSamples: overlapping rows")
+         for table, group in self.__paren.partitions.split(rows):
+            inserted, invalid = insertMany(self.__cursor,
+               "INSERT OR IGNORE INTO %s VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)" % table, 
+               group, "RealTimeSamples", self.__required)
+            commited += inserted
+            rejected += invalid
+         duplicates = len(rows) - commited - rejected
       except sqlite3.OperationalError, e:
+         if not commit:
+            raise   # rolled back by the unit of work
          self.__conn.rollback()
          if e.args[0] != DATABASE_LOCKED:
             raise
@@ -434,54 +780,45 @@ class RealTimeSamples(object):
                 )  
       except sqlite3.Error, e:
          log.error(e)
-         self.__conn.rollback()
+         if commit:
+            self.__conn.rollback()
          raise
-      self.__conn.commit()   # commit anyway what was really updated
-      rowcount = self.rowcount()
-      commited = rowcount -  self.__rowcount
-      self.__rowcount = rowcount
-      log.debug("RealTimeSamples: commited rows (%d/%d)", commited, len(rows))
+      if commit:
+         self.__conn.commit()   # commit anyway what was really updated
+      if duplicates:
+         log.warn("RealTimeSamples: %d duplicate rows ignored", duplicates)
+      log.debug("RealTimeSamples: commited rows (%d/%d), %d rejected", 
+                commited, len(rows), rejected)
       return  commited
 
 
    def row(self, date_id, time_id, station_id, meas_type, tstamp, message):
       '''Produces one real time row to be inserted into the database'''
 
-      # get units from cache
-      units_id = self.__relay.get((xtRoofRelay(message),xtAuxRelay(message)),-1)
       type_id = self.__type.get(meas_type, -1)
-
-      return (
-         date_id,               # date_id
-         time_id,               # time_id
-         station_id,            # station_id
-         type_id,               # type_id
-         units_id,              # units_id
-         xtVoltage(message),    # voltage
-         xtWetLevel(message),   # wet
-         xtCloudLevel(message), # cloudy
-         xtCalPressure(message),   # cal_pressure
-         xtAbsPressure(message),   # abs_pressure
-         xtRain(message),          # rain
-         xtIrradiation(message),   # irradiation
-         xtMagVisual(message),     # vis_magnitude
-         xtFrequency(message),     # frequency
-         xtTemperature(message),   # temperature
-         xtHumidity(message),      # rel_humidity
-         xtDewPoint(message),      # dew_point
-         xtWindSpeed(message),     # wind_speed
-         xtWindSpeed10m(message),  # wind_speed10m
-         xtWindDirection(message), # wind_direction
-         tstamp,                   # timestamp
-      )
+      return self.__extract(date_id, time_id, station_id, type_id, tstamp, 
+                            message)
 
 
-   def delete(self, date_id):
-      '''Delete samples older than a given date_id'''
-      log.debug("Delete RealTimeSamples Table data older than %d", date_id)
+   def delete(self, date_id, time_id, limit):
+      '''
+      Delete up to limit samples older than a given date_id, time_id.
+      Returns the number of deleted rows.
+      '''
+      log.verbose("Delete RealTimeSamples Table data older than %d %04d", 
+                  date_id, time_id)
+      deleted = 0
       try:
+         # Delete by primary key, valid for rowid & WITHOUT ROWID tables
          self.__cursor.execute(
-            "DELETE FROM RealTimeSamples WHERE date_id < ?", (date_id,))
+            "SELECT date_id, time_id, station_id, type_id FROM main.RealTimeSamples WHERE date_id < ? OR (date_id = ? AND time_id < ?) LIMIT ?", 
+            (date_id, date_id, time_id, limit))
+         keys = self.__cursor.fetchall()
+         if keys:
+            self.__cursor.executemany(
+               "DELETE FROM main.RealTimeSamples WHERE date_id = ? AND time_id = ? AND station_id = ? AND type_id = ?", 
+               keys)
+            deleted = self.__cursor.rowcount
       except sqlite3.OperationalError, e:
          self.__conn.rollback()
          if e.args[0] != DATABASE_LOCKED:
@@ -492,11 +829,16 @@ class RealTimeSamples(object):
          self.__conn.rollback()
          raise
       self.__conn.commit()   # commit anyway what was really updated
-      rowcount = self.rowcount()
-      commited = rowcount -  self.__rowcount
-      self.__rowcount = rowcount
-      log.debug("RealTimeSamples: deleted %d rows", commited)
-      return  commited
+      log.verbose("RealTimeSamples: deleted %d rows", deleted)
+      return  deleted
+
+
+   def backlog(self, date_id, time_id):
+      '''Count samples older than a given date_id, time_id'''
+      self.__cursor.execute(
+         "SELECT count(*) FROM main.RealTimeSamples WHERE date_id < ? OR (date_id = ? AND time_id < ?)",
+         (date_id, date_id, time_id))
+      return self.__cursor.fetchone()[0]
 
 
 # ===================
@@ -513,6 +855,7 @@ class HistoryStats(object):
       '''Reconfigures itself after a reload'''
       self.__conn     = conn
       self.__cursor   = self.__conn.cursor()
+      self.__required = notNull(conn, 'HistoryStats')
       paren = self.__paren      # shortcut
       # Build type cache
       self.__type = {
@@ -521,16 +864,20 @@ class HistoryStats(object):
       }      
 
 
-   def insert(self, rows):
+   def insert(self, rows, commit=True):
       '''Update the HistoryStats Fact Table'''
       log.debug("HistoryStats: updating table")
       try:
-         self.__cursor.executemany(
-            "INSERT OR FAIL INTO HistoryStats VALUES(?,?,?,?,?,?,?)", 
-            rows)
-      except sqlite3.IntegrityError, e:
-         log.debug("HistoryStats: duplicate detected, probably a retained message")
+         inserted, rejected = insertMany(self.__cursor, 
+            "INSERT OR IGNORE INTO HistoryStats VALUES(?,?,?,?,?,?,?)", 
+            rows, "HistoryStats", self.__required)
+         if inserted + rejected < len(rows):
+            log.debug("HistoryStats: %d duplicate rows ignored, "
+                      "probably a retained message", 
+                      len(rows) - inserted - rejected)
       except sqlite3.OperationalError, e:
+         if not commit:
+            raise   # rolled back by the unit of work
          self.__conn.rollback()
          if e.args[0] != DATABASE_LOCKED:
             raise
@@ -538,9 +885,11 @@ class HistoryStats(object):
                    len(rows),DATABASE_LOCKED)
       except sqlite3.Error, e:
          log.error(e)
-         self.__conn.rollback()
+         if commit:
+            self.__conn.rollback()
          raise
-      self.__conn.commit()   # commit anyway what was really updated
+      if commit:
+         self.__conn.commit()   # commit anyway what was really updated
 
 
    def rows(self, station_id, meastype, submitted, commited):
@@ -578,6 +927,7 @@ class RealTimeStats(object):
       '''Reconfigures itself after a reload'''
       self.__conn     = conn
       self.__cursor   = self.__conn.cursor()
+      self.__required = notNull(conn, 'RealTimeStats')
       paren = self.__paren      # shortcut
       # Build type cache
       self.__type = {
@@ -586,21 +936,19 @@ class RealTimeStats(object):
       }      
 
 
-   def rowcount(self):
-      '''Find out the current row count'''
-      self.__cursor.execute("SELECT count(*) FROM RealTimeStats")
-      return self.__cursor.fetchone()[0]
-
-   def insert(self, rows):
+   def insert(self, rows, commit=True):
       '''Update the RealTimeStats Fact Table'''
       log.debug("RealTimeStats: updating table")
       try:
-         self.__cursor.executemany(
-            "INSERT OR FAIL INTO RealTimeStats VALUES(?,?,?,?,?,?,?,?,?)", 
-            rows)
-      except sqlite3.IntegrityError, e:
-         log.debug("RealTimeStats: duplicate detected")
+         inserted, rejected = insertMany(self.__cursor, 
+            "INSERT OR IGNORE INTO RealTimeStats VALUES(?,?,?,?,?,?,?,?,?)", 
+            rows, "RealTimeStats", self.__required)
+         if inserted + rejected < len(rows):
+            log.debug("RealTimeStats: %d duplicate rows ignored",
+                      len(rows) - inserted - rejected)
       except sqlite3.OperationalError, e:
+         if not commit:
+            raise   # rolled back by the unit of work
          self.__conn.rollback()
          if e.args[0] != DATABASE_LOCKED:
             raise
@@ -608,9 +956,11 @@ class RealTimeStats(object):
                    len(rows), DATABASE_LOCKED)
       except sqlite3.Error, e:
          log.error(e)
-         self.__conn.rollback()
+         if commit:
+            self.__conn.rollback()
          raise
-      self.__conn.commit()   # commit anyway what was really updated
+      if commit:
+         self.__conn.commit()   # commit anyway what was really updated
 
 
    def rows(self, date_id, time_id, station_id, meas_type, tstamp, 
@@ -632,12 +982,25 @@ class RealTimeStats(object):
          ),
       )
 
-   def delete(self, date_id):
-      '''Delete samples older than a given date_id'''
-      log.debug("Delete RealTimeStats Table data older than %d", date_id)
+   def delete(self, date_id, time_id, limit):
+      '''
+      Delete up to limit samples older than a given date_id, time_id.
+      Returns the number of deleted rows.
+      '''
+      log.verbose("Delete RealTimeStats Table data older than %d %04d", 
+                  date_id, time_id)
+      deleted = 0
       try:
+         # Delete by primary key, valid for rowid & WITHOUT ROWID tables
          self.__cursor.execute(
-            "DELETE FROM RealTimeStats WHERE date_id < ?", (date_id,))
+            "SELECT date_id, time_id, station_id, type_id FROM RealTimeStats WHERE date_id < ? OR (date_id = ? AND time_id < ?) LIMIT ?", 
+            (date_id, date_id, time_id, limit))
+         keys = self.__cursor.fetchall()
+         if keys:
+            self.__cursor.executemany(
+               "DELETE FROM RealTimeStats WHERE date_id = ? AND time_id = ? AND station_id = ? AND type_id = ?", 
+               keys)
+            deleted = self.__cursor.rowcount
       except sqlite3.OperationalError, e:
          self.__conn.rollback()
          if e.args[0] != DATABASE_LOCKED:
@@ -648,11 +1011,1423 @@ class RealTimeStats(object):
          self.__conn.rollback()
          raise
       self.__conn.commit()   # commit anyway what was really updated
-      rowcount = self.rowcount()
-      commited = rowcount -  self.__rowcount
-      self.__rowcount = rowcount
-      log.debug("RealTimeSamples: deleted %d rows", commited)
-      return  commited
+      log.verbose("RealTimeStats: deleted %d rows", deleted)
+      return  deleted
+
+
+   def backlog(self, date_id, time_id):
+      '''Count samples older than a given date_id, time_id'''
+      self.__cursor.execute(
+         "SELECT count(*) FROM RealTimeStats WHERE date_id < ? OR (date_id = ? AND time_id < ?)",
+         (date_id, date_id, time_id))
+      return self.__cursor.fetchone()[0]
+
+# ====================
+# RealTimeBlocks Class
+# ====================
+
+class RealTimeBlocks(object):
+
+   def __init__(self, paren):
+      self.__paren = paren
+
+   def reload(self, conn):            
+      '''Reconfigures itself after a reload'''
+      self.__conn     = conn
+      self.__cursor   = self.__conn.cursor()
+      self.__required = notNull(conn, 'RealTimeBlocks')
+
+
+   def insert(self, rows, commit=True):
+      '''Update the RealTimeBlocks Fact Table'''
+      log.debug("RealTimeBlocks: updating table")
+      try:
+         inserted, rejected = insertMany(self.__cursor, 
+            "INSERT OR IGNORE INTO RealTimeBlocks VALUES(?,?,?,?,?,?)", 
+            rows, "RealTimeBlocks", self.__required)
+         if inserted + rejected < len(rows):
+            log.debug("RealTimeBlocks: %d duplicate rows ignored",
+                      len(rows) - inserted - rejected)
+      except sqlite3.OperationalError, e:
+         if not commit:
+            raise   # rolled back by the unit of work
+         self.__conn.rollback()
+         if e.args[0] != DATABASE_LOCKED:
+            raise
+         log.critical("RealTimeBlocks: %d rows cound not be written: %s",
+                   len(rows), DATABASE_LOCKED)
+      except sqlite3.Error, e:
+         log.error(e)
+         if commit:
+            self.__conn.rollback()
+         raise
+      if commit:
+         self.__conn.commit()   # commit anyway what was really updated
+
+
+   def row(self, date_id, time_id, station_id, type_id, samples):
+      '''
+      Produces one block row to be inserted into the database
+      from a list of (offset, status message) samples
+      '''
+      samples = sorted(samples)
+      return (
+         date_id,
+         time_id,
+         station_id,
+         type_id,
+         len(samples),
+         sqlite3.Binary(encodeStatusBlock([ s[0] for s in samples ], 
+                                          [ s[1] for s in samples ])),
+      )
+
+   def delete(self, date_id, time_id, limit):
+      '''
+      Delete up to limit samples older than a given date_id, time_id.
+      Returns the number of deleted rows.
+      '''
+      log.verbose("Delete RealTimeBlocks Table data older than %d %04d", 
+                  date_id, time_id)
+      deleted = 0
+      try:
+         # Delete by primary key, valid for rowid & WITHOUT ROWID tables
+         self.__cursor.execute(
+            "SELECT date_id, time_id, station_id, type_id FROM RealTimeBlocks WHERE date_id < ? OR (date_id = ? AND time_id < ?) LIMIT ?", 
+            (date_id, date_id, time_id, limit))
+         keys = self.__cursor.fetchall()
+         if keys:
+            self.__cursor.executemany(
+               "DELETE FROM RealTimeBlocks WHERE date_id = ? AND time_id = ? AND station_id = ? AND type_id = ?", 
+               keys)
+            deleted = self.__cursor.rowcount
+      except sqlite3.OperationalError, e:
+         self.__conn.rollback()
+         if e.args[0] != DATABASE_LOCKED:
+            raise
+         log.error("Table could not be purged: %s",DATABASE_LOCKED)
+      except sqlite3.Error, e:
+         log.error(e)
+         self.__conn.rollback()
+         raise
+      self.__conn.commit()   # commit anyway what was really updated
+      log.verbose("RealTimeBlocks: deleted %d rows", deleted)
+      return  deleted
+
+
+   def backlog(self, date_id, time_id):
+      '''Count samples older than a given date_id, time_id'''
+      self.__cursor.execute(
+         "SELECT count(*) FROM RealTimeBlocks WHERE date_id < ? OR (date_id = ? AND time_id < ?)",
+         (date_id, date_id, time_id))
+      return self.__cursor.fetchone()[0]
+
+# ==================
+# Unit of Work Class
+# ==================
+
+class UnitOfWork(object):
+   '''
+   Stages fact rows and their statistics rows in the open transaction
+   and commits them together, so that statistics always match the 
+   committed facts and a single commit is done per message.
+   Units of work nest as savepoints, only the outermost one commits.
+   Table inserts within a unit never roll back by themselves. Should 
+   a unit fail, it is rolled back to its savepoint here, discarding 
+   only its own rows. A locked database is logged and the unit rows 
+   are lost, as in table inserts, other errors are raised.
+   The python 2 sqlite3 module commits the open transaction before 
+   a SAVEPOINT or any other statement but DML, so transactions are 
+   handled here explicitly while a unit is open. Nothing but DML may 
+   be executed within a unit.
+   '''
+
+   def __init__(self, paren):
+      self.__paren      = paren
+      self.__conn       = None
+      self.__level      = None
+      self.__marks      = []
+      self.__staged     = 0
+      self.__committed  = []
+      self.__rolledback = []
+
+
+   def reload(self, conn):
+      self.__conn = conn
+
+
+   def __enter__(self):
+      if not self.__marks:
+         self.__level = self.__conn.isolation_level
+         self.__conn.isolation_level = None   # no implicit BEGIN or COMMIT
+         self.__conn.execute("BEGIN")
+      else:
+         self.__conn.execute("SAVEPOINT unit%d" % len(self.__marks))
+      self.__marks.append((self.__staged, len(self.__committed), 
+                           len(self.__rolledback)))
+      return self
+
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      mark = self.__marks.pop()
+      if self.__marks:
+         if exc_type is None:
+            self.__conn.execute("RELEASE unit%d" % len(self.__marks))
+            return False
+         self.rollbackTo(mark, exc_value)
+      else:
+         try:
+            if exc_type is None:
+               self.commit()
+               return False
+            self.rollback(exc_value)
+         finally:
+            self.__conn.isolation_level = self.__level
+      if not isLocked(exc_value):
+         return False
+      log.critical("Staged rows could not be written: %s", DATABASE_LOCKED)
+      return True
+
+
+   def active(self):
+      '''True within a unit of work'''
+      return bool(self.__marks)
+
+
+   def stage(self, table, rows):
+      '''
+      Insert rows into a fact or statistics table without committing.
+      Returns what the table insert returns.
+      '''
+      self.__staged += 1
+      return table.insert(rows, commit=False)
+
+
+   def onCommit(self, func):
+      '''Call func once the staged rows are committed'''
+      self.__committed.append(func)
+
+
+   def onRollback(self, func):
+      '''Call func should the staged rows be rolled back'''
+      self.__rolledback.append(func)
+
+
+   def commit(self):
+      '''Commit the staged rows'''
+      try:
+         self.__conn.commit()
+      except sqlite3.OperationalError, e:
+         self.rollback(e)
+         if not isLocked(e):
+            raise
+         log.critical("Staged rows could not be written: %s", DATABASE_LOCKED)
+         return
+      callbacks = self.__committed
+      self.__staged     = 0
+      self.__committed  = []
+      self.__rolledback = []
+      for func in callbacks:
+         func()
+
+
+   def rollback(self, error):
+      '''Roll back the whole transaction after an error'''
+      if self.__staged:
+         log.error("Rolling back %d staged inserts: %s", self.__staged, error)
+      callbacks = self.__rolledback
+      self.__staged     = 0
+      self.__committed  = []
+      self.__rolledback = []
+      self.__conn.rollback()
+      for func in callbacks:
+         func()
+
+
+   def rollbackTo(self, mark, error):
+      '''Roll back a nested unit to its savepoint after an error'''
+      name = "unit%d" % len(self.__marks)
+      self.__conn.execute("ROLLBACK TO %s" % name)
+      self.__conn.execute("RELEASE %s" % name)
+      staged, committed, rolledback = mark
+      if self.__staged > staged:
+         log.error("Rolling back %d staged inserts: %s", 
+                   self.__staged - staged, error)
+      callbacks = self.__rolledback[rolledback:]
+      self.__staged = staged
+      del self.__committed[committed:]
+      del self.__rolledback[rolledback:]
+      for func in callbacks:
+         func()
+
+# ===============
+# Retention Class
+# ===============
+
+# Retention ages like 36h or 2d
+RETENTION_RE = re.compile(r'^(\d+)\s*([hd])$', re.I)
+
+def retentionAge(text):
+   '''Parse a retention age in hours (h) or days (d)'''
+   matchobj = RETENTION_RE.match(text.strip())
+   if not matchobj:
+      raise ValueError("Invalid retention age: %s" % text)
+   n = int(matchobj.group(1))
+   if matchobj.group(2).lower() == 'h':
+      return datetime.timedelta(hours=n)
+   return datetime.timedelta(days=n)
+
+
+class Retention(Lazy):
+   '''
+   Rolling retention for the real time tables.
+   Rows older than each table retention age are deleted in batches 
+   of limited size, one batch per table and tick, each one in its own 
+   transaction, so that ingestion is never blocked for long.
+   Ticks every second while there is a backlog and every IDLE seconds 
+   otherwise.
+   '''
+
+   IDLE = 60
+
+   # Log progress every N batches
+   N_BATCHES = 60
+
+   def __init__(self, paren):
+      Lazy.__init__(self, Retention.IDLE)
+      self.__paren    = paren
+      self.__enabled  = False
+      self.__policies = ()
+      self.__batch    = 1
+      self.__purging  = {}
+
+
+   def reload(self, enabled, policies, batch):
+      '''
+      Reconfigures itself after a reload.
+      policies is a sequence of (table object, table name, age) 
+      '''
+      self.__enabled  = enabled
+      self.__policies = policies
+      self.__batch    = max(1, batch)
+      self.__purging  = {}
+      if enabled:
+         log.info("Retention policy: %s, in batches of %d rows",
+                  ", ".join("%s %dh" % (name, age.total_seconds() // 3600) 
+                            for _, name, age in policies), self.__batch)
+      else:
+         log.info("Retention policy disabled")
+
+
+   def cutoff(self, age):
+      '''Returns the (date_id, time_id) to purge from'''
+      t = datetime.datetime.utcnow() - age
+      return t.year*10000 + t.month*100 + t.day, t.hour*100 + t.minute
+
+
+   def purge(self):
+      '''Delete one batch of expired rows per table'''
+      if not self.__enabled:
+         return
+      busy = False
+      for table, name, age in self.__policies:
+         date_id, time_id = self.cutoff(age)
+         deleted = table.delete(date_id, time_id, self.__batch)
+         progress = self.__purging.get(name)
+         if deleted == self.__batch and progress is None:
+            backlog  = deleted + table.backlog(date_id, time_id)
+            progress = [0, backlog, 0, time.time()]
+            self.__purging[name] = progress
+            log.info("%s: purging %d rows older than %d %04d",
+                     name, backlog, date_id, time_id)
+         if progress is None:
+            continue
+         progress[0] += deleted
+         progress[2] += 1
+         if deleted == self.__batch:
+            busy = True
+            if progress[2] % Retention.N_BATCHES == 0:
+               log.info("%s: purge progress %d/%d rows", 
+                        name, progress[0], progress[1])
+         else:
+            del self.__purging[name]
+            log.info("%s: purged %d rows in %d batches, %.1f sec.", 
+                     name, progress[0], progress[2], 
+                     time.time() - progress[3])
+      self.setPeriod(1 if busy else Retention.IDLE)
+
+
+   def busy(self):
+      '''True while purging a backlog of expired rows'''
+      return bool(self.__purging)
+
+
+   def work(self):
+      '''Called periodically from a Server object'''
+      self.__paren.submit(self.purge)
+
+# =================
+# Maintenance Class
+# =================
+
+class Maintenance(Lazy):
+   '''
+   Database maintenance in quiet periods, when there is neither a
+   purge backlog nor pending writter jobs.
+   In INCREMENTAL auto_vacuum mode, free pages left by purges are 
+   given back to the file system, up to a number of pages per tick.
+   Query planner statistics are refreshed by PRAGMA optimize, with
+   a bounded analysis, after freeing pages and every analyze period.
+   Ticks every second while freeing pages and every IDLE seconds 
+   otherwise.
+   '''
+
+   IDLE = 60
+
+   def __init__(self, paren):
+      Lazy.__init__(self, Maintenance.IDLE)
+      self.__paren    = paren
+      self.__pages    = 0
+      self.__vacuum   = None
+      self.__analyzed = time.time()
+
+
+   def reload(self, conn, pages, period, limit):
+      '''Reconfigures itself after a reload'''
+      self.__conn     = conn
+      self.__cursor   = conn.cursor()
+      self.__pages    = pages
+      self.__period   = 3600*period
+      self.__limit    = limit
+      self.__vacuum   = None
+      self.__cursor.execute("PRAGMA auto_vacuum")
+      self.__auto     = self.__cursor.fetchone()[0] == schema.AUTO_VACUUM['INCREMENTAL']
+      log.info("Maintenance: incremental vacuum %s, analysis every %dh", 
+               "%d pages per second" % pages if self.__auto and pages 
+               else "disabled", period)
+
+
+   def pragma(self, statement):
+      '''Execute a PRAGMA statement and returns its first value'''
+      self.__cursor.execute("PRAGMA " + statement)
+      row = self.__cursor.fetchone()
+      self.__cursor.fetchall()
+      return row and row[0]
+
+
+   def vacuum(self):
+      '''
+      Free up to a number of pages. 
+      Returns True while there are free pages left.
+      '''
+      if not (self.__auto and self.__pages):
+         return False
+      free = self.pragma("freelist_count")
+      if self.__vacuum is None:
+         if not free:
+            return False
+         self.__vacuum = [free, 0, 0.0]
+         log.info("Maintenance: %d free pages to release", free)
+      t0 = time.time()
+      self.pragma("incremental_vacuum(%d)" % self.__pages)
+      self.__vacuum[1] += 1
+      self.__vacuum[2] += time.time() - t0
+      left = self.pragma("freelist_count")
+      if left:
+         return True
+      pages, steps, elapsed = self.__vacuum
+      self.__vacuum = None
+      log.info("Maintenance: released %d free pages (%d KiB) in %d steps, %.3f sec.", 
+               pages, pages * self.pragma("page_size") // 1024, steps, elapsed)
+      self.__analyzed = 0
+      return False
+
+
+   def analyze(self):
+      '''Refresh query planner statistics if due'''
+      if time.time() - self.__analyzed < self.__period:
+         return
+      t0 = time.time()
+      self.pragma("analysis_limit = %d" % self.__limit)
+      self.pragma("optimize")
+      self.__analyzed = time.time()
+      log.info("Maintenance: PRAGMA optimize done in %.3f sec.", 
+               self.__analyzed - t0)
+
+
+   def maintain(self):
+      '''One maintenance step, if quiet'''
+      if not self.__paren.quiet():
+         self.setPeriod(Maintenance.IDLE)
+         return
+      busy = self.vacuum()
+      if not busy:
+         self.analyze()
+      self.setPeriod(1 if busy else Maintenance.IDLE)
+
+
+   def work(self):
+      '''Called periodically from a Server object'''
+      self.__paren.submit(self.maintain)
+
+# ================
+# Partitions Class
+# ================
+
+class Partitions(Lazy):
+   '''
+   Optional per-day RealTimeSamples partitions.
+   Real time samples are written to per-day SQLite files, attached 
+   to the connection and joined with the main table in a TEMP view 
+   with the same RealTimeSamples name.
+   Partitions from the oldest retained day up to tomorrow (UTC) are 
+   attached, so that the next one is ready before midnight. 
+   Older partitions are detached and their files removed if purging
+   is enabled. Rows outside this window go to the main table.
+   Partitions cannot be attached within a unit of work, so rows of 
+   a day whose partition is not attached yet go to the main table 
+   too, until it is attached once the unit is over.
+   '''
+
+   # SQLite attaches up to 10 databases by default
+   MAX_DAYS = 8
+
+   def __init__(self, paren):
+      Lazy.__init__(self, 60)
+      self.__paren    = paren
+      self.__enabled  = False
+      self.__attached = {}
+      self.__missing  = set()
+
+
+   def reload(self, conn, enabled, directory, age, purge, without_rowid,
+              rollups):
+      '''Reconfigures itself after a reload'''
+      self.__conn     = conn
+      self.__cursor   = conn.cursor()
+      self.__schema   = schema.RealTimeSamples(conn)
+      self.__rollups  = schema.RealTimeRollups(conn) if rollups else None
+      self.__dir      = directory
+      self.__purge    = purge
+      self.__norowid  = without_rowid
+      self.__scaled   = schema.isScaled(conn, 'RealTimeSamples')
+      self.__epoch    = schema.isEpoch(conn, 'RealTimeSamples')
+      self.__attached = self.attached()
+      for name in self.__attached.values():
+         self.rollups(name)
+      if age > datetime.timedelta(days=Partitions.MAX_DAYS):
+         log.warn("Partitions retention limited to %d days", 
+                  Partitions.MAX_DAYS)
+         age = datetime.timedelta(days=Partitions.MAX_DAYS)
+      self.__age      = age
+      self.__enabled  = enabled
+      if not enabled:
+         if self.__attached:
+            self.__schema.view(())
+            for date_id in sorted(self.__attached):
+               self.__schema.detach(self.__attached.pop(date_id))
+         return
+      if not os.path.isdir(directory):
+         os.makedirs(directory)
+      log.info("RealTimeSamples partitions in %s", directory)
+      self.rotate()
+
+
+   def attached(self):
+      '''Returns the partitions already attached, keyed by date_id'''
+      self.__cursor.execute("PRAGMA database_list")
+      result = {}
+      for _, name, _ in self.__cursor.fetchall():
+         matchobj = PARTITION_RE.match(name)
+         if matchobj:
+            result[int(matchobj.group(1))] = name
+      return result
+
+
+   def window(self):
+      '''Returns the oldest, today and tomorrow date_ids to keep attached'''
+      now = datetime.datetime.utcnow()
+      return tuple(t.year*10000 + t.month*100 + t.day 
+                   for t in (now - self.__age, now, now + ONE_DAY))
+
+
+   def attach(self, date_id):
+      '''Attach a partition with the main database journal mode'''
+      name = self.__schema.attach(self.__dir, date_id, self.__norowid, 
+                                  self.__scaled, self.__epoch)
+      self.__cursor.execute("PRAGMA main.journal_mode")
+      mode = self.__cursor.fetchone()[0]
+      self.__cursor.execute("PRAGMA %s.journal_mode = %s" % (name, mode))
+      self.__cursor.fetchall()
+      self.rollups(name)
+      self.__attached[date_id] = name
+      return name
+
+
+   def rollups(self, name):
+      '''Create or drop the rollups trigger of an attached partition'''
+      if self.__rollups:
+         self.__rollups.trigger(name)
+      else:
+         self.__cursor.execute("DROP TRIGGER IF EXISTS temp.%s_rollup" % name)
+
+
+   def remove(self, date_id):
+      '''Remove a partition file and its companion files'''
+      path = os.path.join(self.__dir, 
+                          schema.RealTimeSamples.PARTITION_FILE % date_id)
+      for suffix in ('', '-wal', '-shm', '-journal'):
+         if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+      log.info("Removed partition file %s", path)
+
+
+   def rotate(self):
+      '''Attach today and tomorrow partitions and drop expired ones'''
+      if not self.__enabled:
+         return
+      first, today, tomorrow = self.window()
+      changed = False
+      expired = [ date_id for date_id in self.__attached if date_id < first ]
+      if expired:
+         self.__schema.view(())
+         changed = True
+      for date_id in sorted(expired):
+         self.__schema.detach(self.__attached.pop(date_id))
+      if self.__purge:
+         for name in os.listdir(self.__dir):
+            matchobj = PARTITION_FILE_RE.match(name)
+            if matchobj and int(matchobj.group(1)) < first:
+               self.remove(int(matchobj.group(1)))
+      for date_id in (today, tomorrow):
+         if date_id not in self.__attached:
+            self.attach(date_id)
+            changed = True
+      if changed:
+         self.view()
+
+
+   def view(self):
+      '''Recreate the RealTimeSamples view over the attached partitions'''
+      self.__schema.view(
+         [ self.__attached[date_id] for date_id in sorted(self.__attached) ])
+
+
+   def prepare(self, rows=()):
+      '''
+      Attach the partitions needed by rows and those found missing 
+      while a unit of work was open. Does nothing within a unit.
+      '''
+      if not self.__enabled or self.__paren.unit.active():
+         return
+      first, _, last = self.window()
+      wanted = self.__missing.union(row[0] for row in rows)
+      self.__missing = set()
+      changed = False
+      for date_id in sorted(wanted):
+         if first <= date_id <= last and date_id not in self.__attached:
+            self.attach(date_id)
+            changed = True
+      if changed:
+         self.view()
+
+
+   def split(self, rows):
+      '''
+      Returns a sequence of (table name, rows) to insert rows into 
+      their partitions, attaching them as needed outside a unit of work.
+      '''
+      if not self.__enabled:
+         return (('RealTimeSamples', rows),)
+      self.prepare(rows)
+      first, _, last = self.window()
+      groups  = {}
+      for row in rows:
+         date_id = row[0]
+         if first <= date_id <= last and date_id in self.__attached:
+            table = self.__attached[date_id] + '.RealTimeSamples'
+         else:
+            if first <= date_id <= last:
+               self.__missing.add(date_id)
+            table = 'main.RealTimeSamples'
+         groups.setdefault(table, []).append(row)
+      return groups.items()
+
+
+   def work(self):
+      '''Called periodically from a Server object'''
+      self.__paren.submit(self.rotate)
+
+# ============
+# Backup Class
+# ============
+
+class Backup(Lazy):
+   '''
+   Online backups of the database into rotated snapshot files.
+   The Python 2 sqlite3 module lacks the SQLite online backup API, 
+   so a snapshot is copied with VACUUM INTO by a copier thread, which
+   holds its read transaction, and so WAL checkpoints, only while
+   copying at SQLite speed. Compressed snapshots are then gzipped 
+   for at most a time slice per tick. With SQLite older than 3.27, 
+   the SQL dump of a single read transaction is replayed into a new 
+   database file (or written compressed) instead, a few statements 
+   per tick and for at most a time slice per tick.
+   Snapshots keep the database auto_vacuum mode.
+   It uses its own connection in the server thread, never the writter
+   thread. Needs WAL journal mode, where the read transaction does not 
+   block ingestion during the whole backup.
+   Per-day RealTimeSamples partitions are not included.
+   '''
+
+   IDLE = 60
+
+   # Check the time slice every N statements
+   N_STATEMENTS = 32
+
+   # Bytes gzipped at a time
+   CHUNK = 1 << 20
+
+   def __init__(self, paren):
+      Lazy.__init__(self, Backup.IDLE)
+      self.__paren   = paren
+      self.__config  = None
+      self.__active  = None
+      self.__enabled = False
+      self.__last    = None
+      self.__conn    = None
+      self.__copier  = None
+      self.__gzip    = None
+      self.__dump    = None
+
+
+   def reload(self, dbfile, enabled, directory, period, keep, compress, 
+              slice_ms):
+      '''
+      Reconfigures itself after a reload. May be called from the 
+      writter thread, so new settings are only taken by the next tick.
+      '''
+      self.__config = (dbfile, enabled, directory, period, keep, compress, 
+                       slice_ms)
+
+
+   def configure(self):
+      '''Apply the settings given by reload(), aborting a backup'''
+      self.abort()
+      self.__active = config = self.__config
+      self.__dbfile, self.__enabled, self.__dir, period, keep, \
+         self.__compress, slice_ms = config
+      self.__keep   = max(1, keep)
+      self.__period = datetime.timedelta(hours=period)
+      self.__slice  = slice_ms / 1000.0
+      self.__name   = os.path.splitext(os.path.basename(self.__dbfile))[0]
+      self.__re     = re.compile(BACKUP_FILE_RE % re.escape(self.__name))
+      if not self.__enabled:
+         log.info("Online backups disabled")
+         return
+      if not os.path.isdir(self.__dir):
+         os.makedirs(self.__dir)
+      snapshots   = self.snapshots()
+      self.__last = snapshots[-1][0] if snapshots else None
+      log.info("Online backups every %dh into %s, keeping %d", 
+               period, self.__dir, self.__keep)
+
+
+   def snapshots(self):
+      '''Returns a sorted list of (datetime, file name) snapshots'''
+      result = []
+      for name in os.listdir(self.__dir):
+         matchobj = self.__re.match(name)
+         if matchobj:
+            result.append((datetime.datetime.strptime(matchobj.group(1), 
+                                                      BACKUP_TIME_FMT), name))
+      return sorted(result)
+
+
+   def start(self):
+      '''Begin a new snapshot'''
+      conn = sqlite3.connect(self.__dbfile, isolation_level=None,
+                             check_same_thread=False)
+      mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+      if mode.lower() != 'wal':
+         conn.close()
+         log.error("Online backups need WAL journal mode, not %s", mode)
+         self.__last = datetime.datetime.utcnow()
+         return
+      vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+      self.__vacuum = [ name for name, value in schema.AUTO_VACUUM.items() 
+                        if value == vacuum ][0]
+      into = sqlite3.sqlite_version_info >= VACUUM_INTO
+      if self.__compress:
+         extension = "db.gz" if into else "sql.gz"
+      else:
+         extension = "db"
+      self.__started = datetime.datetime.utcnow()
+      stem = os.path.join(self.__dir, "%s-%s" % (self.__name, 
+                  self.__started.strftime(BACKUP_TIME_FMT)))
+      self.__file  = "%s.%s" % (stem, extension)
+      self.__copy  = stem + ".db.part"
+      self.__count = 0
+      self.__conn  = conn
+      log.info("Starting backup into %s", self.__file)
+      if into:
+         self.__error  = None
+         self.__copier = threading.Thread(target=self.copy, name="backup")
+         self.__copier.daemon = True
+         self.__copier.start()
+         return
+      conn.execute("BEGIN")
+      version = conn.execute("PRAGMA user_version").fetchone()[0]
+      if self.__compress:
+         target = gzip.open(self.__file + ".part", "wb")
+      else:
+         target = sqlite3.connect(self.__copy, isolation_level=None)
+         schema.autoVacuum(target, self.__vacuum)
+         target.execute("PRAGMA journal_mode = OFF")
+         target.execute("PRAGMA synchronous = OFF")
+      statements = itertools.chain(
+         ("PRAGMA auto_vacuum = %s;" % self.__vacuum,),
+         conn.iterdump(), 
+         ("PRAGMA user_version = %d;" % version,))
+      self.__dump = (target, statements)
+
+
+   def copy(self):
+      '''
+      Copier thread. VACUUM INTO the snapshot file and make sure it
+      has the database auto_vacuum mode.
+      '''
+      try:
+         self.__conn.execute("VACUUM INTO ?", (self.__copy,))
+         target = sqlite3.connect(self.__copy, isolation_level=None)
+         try:
+            if not schema.autoVacuum(target, self.__vacuum):
+               target.execute("VACUUM")
+         finally:
+            target.close()
+      except sqlite3.Error, e:
+         self.__error = e
+
+
+   def step(self):
+      '''Progress for at most a time slice, returns True when done'''
+      deadline = time.time() + self.__slice
+      if self.__dump is not None:
+         return self.replay(deadline)
+      if self.__gzip is None:
+         if self.__copier.is_alive():
+            return False
+         if self.__error is not None:
+            raise self.__error
+         if not self.__compress:
+            return True
+         self.__gzip = (open(self.__copy, "rb"), 
+                        gzip.open(self.__file + ".part", "wb"))
+      source, target = self.__gzip
+      while time.time() < deadline:
+         chunk = source.read(Backup.CHUNK)
+         if not chunk:
+            return True
+         target.write(chunk)
+      return False
+
+
+   def replay(self, deadline):
+      '''Dump statements until the deadline, returns True when done'''
+      target, statements = self.__dump
+      N = Backup.N_STATEMENTS
+      for statement in statements:
+         if self.__compress:
+            target.write(statement.encode('utf-8') + '\n')
+         else:
+            target.execute(statement)
+         self.__count += 1
+         if self.__count % N == 0 and time.time() > deadline:
+            return False
+      return True
+
+
+   def close(self):
+      '''Release the connection, copier thread and files of a backup'''
+      if self.__copier is not None:
+         self.__conn.interrupt()
+         self.__copier.join()
+         self.__copier = None
+      if self.__dump is not None:
+         self.__dump[0].close()
+         self.__dump = None
+      if self.__gzip is not None:
+         for f in self.__gzip:
+            f.close()
+         self.__gzip = None
+      self.__conn.close()
+      self.__conn = None
+
+
+   def finish(self):
+      '''Complete a snapshot and remove the oldest ones'''
+      if self.__dump is not None:
+         self.__conn.execute("COMMIT")
+      self.close()
+      if self.__compress:
+         if os.path.exists(self.__copy):
+            os.remove(self.__copy)
+         os.rename(self.__file + ".part", self.__file)
+      else:
+         os.rename(self.__copy, self.__file)
+      self.__last = self.__started
+      log.info("Backup %s completed in %d seconds", self.__file,
+               (datetime.datetime.utcnow() - self.__started).total_seconds())
+      for _, name in self.snapshots()[:-self.__keep]:
+         log.info("Removing old backup %s", name)
+         os.remove(os.path.join(self.__dir, name))
+
+
+   def abort(self):
+      '''Abandon a backup in progress'''
+      if self.__conn is None:
+         return
+      self.close()
+      for name in (self.__copy, self.__file + ".part"):
+         if os.path.exists(name):
+            os.remove(name)
+      log.warn("Backup %s aborted", self.__file)
+
+
+   def report(self):
+      '''Log the age of the last backup'''
+      if not self.__enabled:
+         return
+      if self.__last is None:
+         log.info("No backup made yet")
+         return
+      age = datetime.datetime.utcnow() - self.__last
+      log.info("Last backup %s UTC, %.1f hours ago", 
+               self.__last.strftime("%Y-%m-%d %H:%M:%S"), 
+               age.total_seconds() / 3600)
+
+
+   def work(self):
+      '''Called periodically from a Server object'''
+      if self.__config is not self.__active:
+         self.configure()
+      if not self.__enabled:
+         return
+      try:
+         if self.__conn is None:
+            now = datetime.datetime.utcnow()
+            if self.__last is not None and now - self.__last < self.__period:
+               return
+            self.start()
+            if self.__conn is None:
+               return
+            self.setPeriod(1)
+         if self.step():
+            self.finish()
+            self.setPeriod(Backup.IDLE)
+      except (sqlite3.Error, IOError, OSError), e:
+         log.error("Backup failed: %s", e)
+         self.abort()
+         self.setPeriod(Backup.IDLE)
+
+# ==============
+# Calendar Class
+# ==============
+
+class Calendar(object):
+   '''
+   Keeps the Date dimension populated on demand, one month at a time,
+   for dates outside the preloaded years. Months present in the Date 
+   table are flagged in a bitmap indexed by date_id // 100 (YYYYMM),
+   so the check for already known dates is a single array lookup.
+   '''
+
+   # Bitmap covers years 1900 to 2199
+   BASE  = 190000
+   SIZE  = 30000
+
+   def __init__(self, paren):
+      self.__paren = paren
+      self.__known = bytearray(Calendar.SIZE)
+
+
+   def reload(self, conn, date_fmt):
+      self.__date  = schema.Date(conn, date_fmt, 1900, 1900)
+      known = bytearray(Calendar.SIZE)
+      for month, in conn.execute(
+         "SELECT DISTINCT date_id / 100 FROM Date WHERE date_id > 0"):
+         known[month - Calendar.BASE] = 1
+      self.__known = known
+
+
+   def check(self, rows):
+      '''Make sure the Date dimension holds the date_id of all rows'''
+      known = self.__known
+      for row in rows:
+         i = row[0] // 100 - Calendar.BASE
+         if not (0 <= i < Calendar.SIZE and known[i]):
+            self.extend(row[0])
+
+
+   def extend(self, date_id):
+      '''Insert the month of a given date_id into the Date dimension'''
+      year, month = date_id // 10000, (date_id // 100) % 100
+      if not (1900 <= year < 2200 and 1 <= month <= 12):
+         log.warn("Date %d out of the Date dimension range", date_id)
+         return
+      # The month is committed or rolled back with the rows needing it
+      self.__date.month(year, month, commit=False)
+      i = date_id // 100 - Calendar.BASE
+      self.__known[i] = 1
+      self.__paren.unit.onRollback(lambda: self.forget(i))
+
+
+   def forget(self, i):
+      '''Unflag a month whose insertion was rolled back'''
+      self.__known[i] = 0
+
+# ===============
+# Coalescer Class
+# ===============
+
+# Coalescing modes
+COALESCE_MODES = ('no', 'first', 'last', 'mean')
+
+class Coalescer(Lazy):
+   '''
+   Per station minute coalescer for real time status messages.
+   RealTimeSamples keeps one row per minute, station and type,
+   so extra messages within the same minute are merged in memory
+   instead of being rejected by the database as duplicates.
+   One row per minute slot is handed to the write behind buffer when
+   the minute closes, that is, when a later minute arrives for the 
+   same station and type or one minute after its first message at 
+   the latest. Late messages for a recently closed minute are dropped.
+   When blocks are enabled, every message of a minute slot is also
+   kept and packed into a RealTimeBlocks row when it closes.
+   Modes:
+   - first : keep the first sample, as INSERT OR IGNORE would do.
+   - last  : keep the last sample.
+   - mean  : average the measurements, taking the relays and wind 
+             direction from the last sample, and add up the number 
+             of samples and bytes of their stats.
+   '''
+
+   # Seconds a minute slot stays open
+   MINUTE  = 60
+
+   # Seconds closed minutes are remembered
+   HORIZON = 600
+
+   # RealTimeSamples row columns averaged in mean mode 
+   # (voltage to wind_speed10m)
+   MEAN    = range(5, 19)
+
+   # RealTimeStats row columns added in mean mode 
+   # (num_samples, num_bytes)
+   SUM     = (6, 7)
+
+   def __init__(self, paren):
+      Lazy.__init__(self, 1)
+      self.__paren   = paren
+      self.__mode    = 'no'
+      self.__blocks  = False
+      self.__slots   = {}
+      self.__current = {}
+      self.__closed  = {}
+      self.__reset()
+
+
+   def __reset(self):
+      self.__messages  = 0
+      self.__written   = 0
+      self.__dropped   = 0
+
+
+   def reload(self, mode, blocks):
+      '''Reconfigures itself after a reload'''
+      mode = mode.lower()
+      if mode not in COALESCE_MODES:
+         raise ValueError("Invalid dbase_coalesce value: %s" % mode)
+      if blocks and mode == 'no':
+         log.warn("RealTimeBlocks need coalescing, using 'first'")
+         mode = 'first'
+      self.flush()
+      self.__mode   = mode
+      self.__blocks = blocks
+      log.info("RealTimeSamples coalescing: %s, blocks %s", mode, 
+               "enabled" if blocks else "disabled")
+
+
+   def append(self, row, stats, message):
+      '''
+      Coalesce one real time sample and its statistics rows.
+      message is the status message the sample comes from.
+      '''
+      if self.__mode == 'no':
+         self.__paren.writebehind.append((row,), stats)
+         return
+      self.__messages += 1
+      station = (row[2], row[3])          # station_id, type_id
+      minute  = (row[0], row[1])          # date_id, time_id
+      current = self.__current.get(station)
+      if current is None or minute > current:
+         self.__current[station] = minute
+         if (station, current) in self.__slots:
+            self.close((station, current))
+      key  = (station, minute)
+      slot = self.__slots.get(key)
+      if slot is None:
+         if key in self.__closed:
+            self.__dropped += 1
+            return
+         slot = [time.time(), 1, row, stats, []]
+         self.__slots[key] = slot
+      elif self.__mode == 'last':
+         slot[2:4] = [row, stats]
+      elif self.__mode == 'mean':
+         self.merge(slot, row, stats)
+      if self.__blocks:
+         slot[4].append((blockOffset(row[1], row[20]), message))
+
+
+   def merge(self, slot, row, stats):
+      '''Accumulates a sample into its minute slot in mean mode'''
+      if slot[1] == 1:
+         # first merge: switch the kept row to running sums
+         slot[2] = list(slot[2])
+         slot[3] = [list(s) for s in slot[3]]
+      slot[1] += 1
+      acc = slot[2]
+      for i in Coalescer.MEAN:
+         if acc[i] is None or row[i] is None:
+            acc[i] = acc[i] if row[i] is None else row[i]
+         else:
+            acc[i] += row[i]
+      acc[4]   = row[4]                   # units_id
+      acc[19:] = row[19:]                 # wind direction, timestamp
+      for acc, s in zip(slot[3], stats):
+         for i in Coalescer.SUM:
+            acc[i] += s[i]
+
+
+   def close(self, key):
+      '''Write the row of a closed minute slot'''
+      _, n, row, stats, samples = self.__slots.pop(key)
+      self.__closed[key] = time.time()
+      blocks = ()
+      if samples:
+         (station_id, type_id), (date_id, time_id) = key
+         blocks = (self.__paren.rtblocks.row(date_id, time_id, station_id,
+                                             type_id, samples),)
+      if n > 1 and self.__mode == 'mean':
+         for i in Coalescer.MEAN:
+            if isinstance(row[i], float):
+               row[i] = row[i] / n
+            elif row[i] is not None:
+               row[i] = int(round(float(row[i]) / n))
+         row   = tuple(row)
+         stats = tuple(tuple(s) for s in stats)
+      self.__written += 1
+      self.__paren.writebehind.append((row,), stats, blocks)
+
+
+   def flushIf(self):
+      '''Close the minute slots open for more than a minute'''
+      now = time.time()
+      for key in [k for k, slot in self.__slots.iteritems() 
+                  if slot[0] <= now - Coalescer.MINUTE]:
+         self.close(key)
+      for key in [k for k, t in self.__closed.iteritems() 
+                  if t <= now - Coalescer.HORIZON]:
+         del self.__closed[key]
+
+
+   def flush(self):
+      '''Close all minute slots'''
+      for key in self.__slots.keys():
+         self.close(key)
+
+
+   def report(self):
+      '''Log and reset the metrics gathered since the last report'''
+      if self.__messages:
+         log.info("RealTimeSamples coalescing: %d messages, %d rows, "
+                  "%d late messages dropped", 
+                  self.__messages, self.__written, self.__dropped)
+      self.__reset()
+
+
+   def work(self):
+      '''Called periodically from a Server object'''
+      self.__paren.submit(self.flushIf)
+
+# =================
+# WriteBehind Class
+# =================
+
+class WriteBehind(Lazy):
+   '''
+   Write behind buffer for RealTimeSamples, RealTimeStats and 
+   RealTimeBlocks rows.
+   Buffered rows are flushed in a single transaction when either 
+   the row count or the latency bound is reached.
+   Rows still in the buffer are lost if the process crashes, so the
+   loss is bounded by these two limits. A size of 1 disables buffering.
+   '''
+
+   def __init__(self, paren):
+      Lazy.__init__(self, 1)
+      self.__paren   = paren
+      self.__samples = []
+      self.__stats   = []
+      self.__blocks  = []
+      self.__oldest  = None
+      self.__size    = 1
+      self.__latency = 0
+
+
+   def reload(self, size, latency):
+      '''Reconfigures itself after a reload'''
+      self.__size    = max(1, size)
+      self.__latency = latency
+      log.info("RealTimeSamples write behind buffer: %d rows, %d sec.",
+               self.__size, self.__latency)
+      self.flushIf()
+
+
+   def append(self, samples, stats, blocks=()):
+      '''Buffer real time samples, their statistics and block rows'''
+      if self.__oldest is None:
+         self.__oldest = time.time()
+      self.__samples.extend(samples)
+      self.__stats.extend(stats)
+      self.__blocks.extend(blocks)
+      self.flushIf()
+
+
+   def flushIf(self):
+      '''Flush if any of the bounds has been reached'''
+      if self.__oldest is None:
+         return
+      if (len(self.__samples) >= self.__size or 
+          time.time() - self.__oldest >= self.__latency):
+         self.flush()
+
+
+   def flush(self):
+      '''Write all buffered rows in a single transaction'''
+      if self.__oldest is None:
+         return
+      samples, stats, blocks = self.__samples, self.__stats, self.__blocks
+      self.__samples = []
+      self.__stats   = []
+      self.__blocks  = []
+      self.__oldest  = None
+      self.__paren.writeRealTime(samples, stats, blocks)
+
+
+   def work(self):
+      '''Called periodically from a Server object'''
+      self.__paren.submit(self.flushIf)
+
+
+# =======================
+# Bulk dump parsing stage
+# =======================
+
+class Parsed(object):
+   '''Dump parsed inline when its rows are got, with the AsyncResult interface'''
+
+   def __init__(self, args):
+      self.__args = args
+
+   def ready(self):
+      return True
+
+   def get(self):
+      return parseDump(*self.__args)
+
+
+class DumpParser(Lazy):
+   '''
+   Parses hourly bulk dumps into rows, either inline or in a pool 
+   of worker processes, so that dumps from several stations arriving 
+   at the same time are parsed in parallel.
+   Payloads smaller than a threshold are always parsed inline.
+   Dumps from the same station are parsed together, and one by one
+   only if that fails, so that a malformed dump does not discard 
+   the others. Parsed rows are inserted by the parent in arrival order,
+   and rows failing to be inserted do not discard the other dumps either.
+   '''
+
+   # Lines per record, by fact table
+   RECORD = { 'MinMaxHistory': 3, 'AveragesHistory': 2 }
+
+   def __init__(self, paren, size):
+      Lazy.__init__(self, 1)
+      self.__paren     = paren
+      self.__pending   = collections.deque()
+      self.__threshold = 0
+      self.__pool      = None
+      if size > 0 and os.name != "posix":
+         log.warn("Parsing process pool not supported on this platform")
+      elif size > 0:
+         self.__pool = multiprocessing.Pool(size, poolInit)
+         log.info("Parsing process pool started with %d workers", size)
+
+
+   def reload(self, threshold):
+      '''Reconfigures itself after a reload'''
+      self.__threshold = threshold
+      self.drain(wait=True)
+
+
+   def parse(self, table, meas_type, station_id, payloads):
+      '''
+      Parse the bulk dump payloads from a station and queue their rows 
+      for insertion. Payloads made of whole records are joined and 
+      parsed at once, any other payload is parsed on its own.
+      '''
+      size   = DumpParser.RECORD[table.dumpArgs()[0]]
+      whole  = [ p for p in payloads if (p.count('\n') + 1) % size == 0 ]
+      groups = [ [p] for p in payloads if (p.count('\n') + 1) % size != 0 ]
+      if whole:
+         groups.insert(0, whole)
+      for group in groups:
+         payload = '\n'.join(group)
+         args = table.dumpArgs() + (station_id, payload)
+         if self.__pool is None or len(payload) < self.__threshold:
+            result = Parsed(args)
+         else:
+            result = self.__pool.apply_async(parseDump, args)
+         self.__pending.append((table, meas_type, station_id, group, result))
+      self.drain()
+
+
+   def drain(self, wait=False):
+      '''Insert parsed rows in arrival order, as long as they are ready'''
+      while self.__pending and (wait or self.__pending[0][4].ready()):
+         table, meas_type, station_id, payloads, result = self.__pending.popleft()
+         try:
+            rows = result.get()
+         except Exception:
+            if len(payloads) == 1:
+               log.exception("Error parsing bulk dump from station %d", 
+                             station_id)
+               continue
+            log.warn("Error parsing %d bulk dumps from station %d, "
+                     "parsing them one by one", len(payloads), station_id)
+            rows = self.parseEach(table, station_id, payloads)
+            if not rows:
+               continue
+         try:
+            self.__paren.writeHistory(table, meas_type, station_id, rows)
+         except Exception:
+            log.exception("Error writing bulk dump rows from station %d", 
+                          station_id)
+
+
+   def parseEach(self, table, station_id, payloads):
+      '''Parse payloads inline one by one, skipping malformed dumps'''
+      rows = []
+      for payload in payloads:
+         try:
+            rows.extend(parseDump(*(table.dumpArgs() + (station_id, payload))))
+         except Exception:
+            log.exception("Error parsing bulk dump from station %d", 
+                          station_id)
+      return rows
+
+
+   def stop(self):
+      '''Terminates the worker processes'''
+      if self.__pool:
+         self.__pool.close()
+         self.__pool.join()
+         self.__pool = None
+
+
+   def work(self):
+      '''Called periodically from a Server object'''
+      if self.__pending:
+         self.__paren.submit(self.drain)
+
+
+# =======================
+# Database writter thread
+# =======================
+
+class WriterThread(threading.Thread):
+   '''
+   Worker thread owning the database connection.
+   Jobs are (callable, args) pairs executed in submission order.
+   The job queue is bounded, so a slow database blocks the submitter
+   and this stall time is accounted for together with queue depth
+   and job latency (time from submission to execution).
+   '''
+
+   def __init__(self, size):
+      threading.Thread.__init__(self, name="dbwritter")
+      self.daemon   = True
+      self.__queue  = Queue.Queue(size)
+      self.__lock   = threading.Lock()
+      self.__reset()
+
+
+   def __reset(self):
+      self.__jobs     = 0
+      self.__maxdepth = 0
+      self.__stalled  = 0.0
+      self.__maxstall = 0.0
+      self.__maxlag   = 0.0
+
+
+   def submit(self, func, *args):
+      '''Queue a job, blocking while the queue is full'''
+      t0 = time.time()
+      self.__queue.put((t0, func, args))
+      stall = time.time() - t0
+      depth = self.__queue.qsize()
+      with self.__lock:
+         self.__stalled  += stall
+         self.__maxstall  = max(self.__maxstall, stall)
+         self.__maxdepth  = max(self.__maxdepth, depth)
+
+
+   def run(self):
+      while True:
+         t0, func, args = self.__queue.get()
+         if func is None:
+            break
+         lag = time.time() - t0
+         with self.__lock:
+            self.__jobs  += 1
+            self.__maxlag = max(self.__maxlag, lag)
+         try:
+            func(*args)
+         except Exception:
+            log.exception("Error in database writter thread")
+
+
+   def stop(self):
+      '''Wait for pending jobs to complete and end the thread'''
+      self.__queue.put((time.time(), None, ()))
+      self.join()
+
+
+   def idle(self):
+      '''True if there are no pending jobs'''
+      return self.__queue.empty()
+
+
+   def report(self):
+      '''Log and reset the metrics gathered since the last report'''
+      with self.__lock:
+         log.info("Writter thread: %d jobs, queue depth %d (max %d), "
+                  "stalled %.3f sec. (max %.3f), max latency %.3f sec.",
+                  self.__jobs, self.__queue.qsize(), self.__maxdepth,
+                  self.__stalled, self.__maxstall, self.__maxlag)
+         self.__reset()
 
 # ==========
 # Main Class
@@ -662,6 +2437,15 @@ class DBWritter(Lazy):
 
    N_RT_WRITES = 60
 
+   # Bulk dump message kinds: (name for logs, fact table attribute, type)
+   DUMP_KINDS = {
+      'minmax':   ("minmax",           'minmax',   TYP_MINMAX),
+      'averages': ("averages history", 'aver5min', TYP_AVER),
+   }
+
+   # Unregistered stations cache size
+   MAX_UNKNOWN = 1000
+
    def __init__(self, srv, parser):
       Lazy.__init__(self, 60)
       self.srv        = srv
@@ -675,11 +2459,56 @@ class DBWritter(Lazy):
       self.aver5min   = AveragesHistory(self)
       self.histats    = HistoryStats(self)
       self.rtstats    = RealTimeStats(self)
+      self.rtblocks   = RealTimeBlocks(self)
+      self.unit       = UnitOfWork(self)
+      self.writebehind = WriteBehind(self)
+      self.coalescer  = Coalescer(self)
+      self.retention  = Retention(self)
+      self.maintenance = Maintenance(self)
+      self.partitions = Partitions(self)
+      self.calendar   = Calendar(self)
+      self.backup     = Backup(self)
+      self.__writer   = None
+      # Not reconfigurable by reload
+      # Worker processes are forked before opening the database
+      self.dumps      = DumpParser(self, parser.getint("DBASE",
+                                                       "dbase_pool_size"))
       srv.addLazy(self)
+      srv.addLazy(self.coalescer)
+      srv.addLazy(self.writebehind)
+      srv.addLazy(self.dumps)
+      srv.addLazy(self.retention)
+      srv.addLazy(self.maintenance)
+      srv.addLazy(self.partitions)
+      srv.addLazy(self.backup)
+      if parser.getboolean("DBASE", "dbase_writer_thread"):
+         self.__writer = WriterThread(parser.getint("DBASE", 
+                                                    "dbase_queue_size"))
       self.reload()
+      if self.__writer:
+         # from now on, the connection is only used by the writter thread
+         self.__writer.start()
+         log.info("Database writter thread started")
       log.info("DBWritter object created")
 
 
+   def submit(self, func, *args):
+      '''
+      Execute a database job, either in the writter thread 
+      if configured or right now
+      '''
+      if self.__writer:
+         self.__writer.submit(func, *args)
+      else:
+         func(*args)
+
+
+   def quiet(self):
+      '''True if neither purging nor having pending jobs'''
+      return (not self.retention.busy() and 
+              (self.__writer is None or self.__writer.idle()))
+
+
    def reload(self):
       '''Reload config data and reconfigure itself'''
       parser      = self.__parser
@@ -691,29 +2520,77 @@ class DBWritter(Lazy):
       year_start  = parser.getint("DBASE", "dbase_year_start")
       year_end    = parser.getint("DBASE", "dbase_year_end")
       purge_flag  = parser.getboolean("DBASE", "dbase_purge")
+      purge_batch = parser.getint("DBASE", "dbase_purge_batch")
+      rt_age      = retentionAge(parser.get("DBASE", "dbase_realtime_retention"))
+      rts_age     = retentionAge(parser.get("DBASE", "dbase_rtstats_retention"))
       stats_flag  = parser.getboolean("DBASE", "dbase_stats")
-      self.__purge = purge_flag
+      buf_size    = parser.getint("DBASE", "dbase_buffer_size")
+      buf_latency = parser.getint("DBASE", "dbase_buffer_latency")
+      coalesce    = parser.get("DBASE", "dbase_coalesce")
+      blocks      = parser.getboolean("DBASE", "dbase_realtime_blocks")
+      threshold   = parser.getint("DBASE", "dbase_pool_threshold")
+      part_flag   = parser.getboolean("DBASE", "dbase_partitions")
+      part_dir    = parser.get("DBASE", "dbase_partition_dir")
+      st_indexes  = parser.getboolean("DBASE", "dbase_station_indexes")
+      no_rowid    = parser.getboolean("DBASE", "dbase_without_rowid")
+      roll_flag   = parser.getboolean("DBASE", "dbase_rollups")
+      scaled      = parser.getboolean("DBASE", "dbase_scaled_integers")
+      epoch       = parser.getboolean("DBASE", "dbase_epoch_timestamps")
+      auto_vacuum = parser.get("DBASE", "dbase_auto_vacuum")
+      vac_pages   = parser.getint("DBASE", "dbase_vacuum_pages")
+      an_period   = parser.getint("DBASE", "dbase_analyze_period")
+      an_limit    = parser.getint("DBASE", "dbase_analysis_limit")
+      backup      = (
+         parser.getboolean("DBASE", "dbase_backup"),
+         parser.get("DBASE", "dbase_backup_dir"),
+         parser.getint("DBASE", "dbase_backup_period"),
+         parser.getint("DBASE", "dbase_backup_keep"),
+         parser.getboolean("DBASE", "dbase_backup_compress"),
+         parser.getint("DBASE", "dbase_backup_slice"),
+      )
+      profile     = (
+         ('journal_mode',       parser.get("DBASE", "dbase_journal_mode")),
+         ('synchronous',        parser.get("DBASE", "dbase_synchronous")),
+         ('cache_size',         parser.getint("DBASE", "dbase_cache_size")),
+         ('mmap_size',          parser.getint("DBASE", "dbase_mmap_size")),
+         ('temp_store',         parser.get("DBASE", "dbase_temp_store")),
+         ('busy_timeout',       parser.getint("DBASE", "dbase_busy_timeout")),
+         ('wal_autocheckpoint', parser.getint("DBASE", "dbase_wal_autocheckpoint")),
+      )
       self.__stats = stats_flag
       log.setLevel(lvl)
       self.period = period
       self.setPeriod(60*period)
+      if self.__conn is not None:
+         self.dumps.drain(wait=True)
+         self.coalescer.flush()
+         self.writebehind.flush()
       try:
          if self.__conn is not None and self.__file != dbfile:
             self.__conn.close()
             self.__conn = None
          if self.__conn is None:
             log.debug("opening database %s", dbfile)
-            self.__conn    = sqlite3.connect(dbfile)
+            self.__conn    = sqlite3.connect(dbfile, 
+                                 check_same_thread=self.__writer is None)
          else:
             log.debug("reusing database connection to %s", dbfile)
          self.__cursor  = self.__conn.cursor()
          self.__file    = dbfile
+         self.tune(profile)
          schema.generate(self.__conn,
                          json_dir,
                          date_fmt,
                          year_start,
                          year_end,
-                         replace=False)
+                         replace=False,
+                         station_indexes=st_indexes,
+                         without_rowid=no_rowid,
+                         rollups=roll_flag,
+                         scaled=scaled,
+                         epoch=epoch,
+                         auto_vacuum=auto_vacuum,
+                         blocks=blocks)
       except sqlite3.OperationalError, e:
          self.__conn.rollback()
          if e.args[0] != DATABASE_LOCKED:
@@ -726,11 +2603,29 @@ class DBWritter(Lazy):
          if self.__conn:
             self.__conn.rollback()
          raise
+      self.loadStations()
+      self.calendar.reload(self.__conn, date_fmt)
       self.minmax.reload(self.__conn)
       self.aver5min.reload(self.__conn)
       self.realtime.reload(self.__conn)
       self.histats.reload(self.__conn)
       self.rtstats.reload(self.__conn)
+      self.rtblocks.reload(self.__conn)
+      self.unit.reload(self.__conn)
+      self.partitions.reload(self.__conn, part_flag, part_dir, rt_age, 
+                             purge_flag, no_rowid, roll_flag)
+      self.coalescer.reload(coalesce, blocks)
+      self.writebehind.reload(buf_size, buf_latency)
+      self.dumps.reload(threshold)
+      policies = [
+         (self.realtime, 'RealTimeSamples', rt_age),
+         (self.rtstats,  'RealTimeStats',   rts_age),
+      ]
+      if blocks:
+         policies.append((self.rtblocks, 'RealTimeBlocks', rt_age))
+      self.retention.reload(purge_flag, policies, purge_batch)
+      self.maintenance.reload(self.__conn, vac_pages, an_period, an_limit)
+      self.backup.reload(dbfile, *backup)
       log.debug("Reload complete")
       
 
@@ -747,28 +2642,9 @@ class DBWritter(Lazy):
       log.debug("Received minmax history message from station %s", mqtt_id)
       station_id = self.lkStation(mqtt_id)
       if station_id == UNKNOWN_STATION_ID:
-         log.warn("Ignoring minmax message from unregistered station %s", 
-                  mqtt_id)
+         self.unregistered(mqtt_id, "minmax")
          return
-      rows = []
-      message = payload.split('\n')
-      msglen = len(message)
-      for i in range(0 , msglen/3):
-         date_id, time_id, t0 = xtDateTime(message[3*i+2])
-         tsmp = t0.strftime("%Y-%m-%d %H:%M:%S")
-         r = self.minmax.row(date_id, time_id, station_id, tsmp, message[3*i])
-         rows.append(r)
-         r = self.minmax.row(date_id, time_id, station_id, tsmp, message[3*i+1])
-         rows.append(r)
-      # It seemd there is no need to sort the dates
-      # non-overlapping data do get written anyway 
-      #rows = sorted(rows, key=operator.itemgetter(0,1), reverse=True)
-      commited = self.minmax.insert(rows)
-      if self.__stats:
-         # Insert record into the statistics table
-         self.histats.insert(
-            self.histats.rows(station_id, TYP_MINMAX, len(rows), commited)
-         )
+      self.dumps.parse(self.minmax, TYP_MINMAX, station_id, [payload])
 
 
    # -------------------------------
@@ -781,37 +2657,33 @@ class DBWritter(Lazy):
       '''
       station_id = self.lkStation(mqtt_id)
       if station_id == UNKNOWN_STATION_ID:
-         log.warn("Ignoring status message from unregistered station %s", 
-                  mqtt_id)
+         self.unregistered(mqtt_id, "status")
          return
       message = payload.split('\n')
       if len(message) != 2:
          log.error("Wrong current status message from station %s", mqtt_id)
          return
-      date_id, time_id, t0 = xtDateTime(message[1])
-
-      tstamp = t0.strftime("%Y-%m-%d %H:%M:%S")
+      date_id, time_id, tstamp = xtTimestamp(message[1], self.realtime.epoch)
       log.debug("Received current status message from station %s", mqtt_id)
 
       type_m = TYP_SAMPLES
       row = self.realtime.row(date_id, time_id, station_id, type_m, tstamp, 
                               message[0])
-      self.__rtwrites += self.realtime.insert((row,))
-      if (self.__rtwrites % DBWritter.N_RT_WRITES) == 1:
-         log.info("RealTimeSamples rows written so far: %d" % self.__rtwrites)
 
       # Compute and store statistics
       # lag = measured lag MQTT[local] -  RPi[remote]
       # the timestamp reference is RPi[remote]
+      stats = ()
       if self.__stats:
+         _, _, t0 = xtDateTime(message[1])
          lag  = int(round((t1 - t0).total_seconds()))
          nbytes = len(payload)
          num_samples = 1
          window_size = 0           # by definition (1 sample)
-         self.rtstats.insert(
-            self.rtstats.rows(date_id, time_id, station_id, type_m, tstamp, 
-                              window_size, num_samples, nbytes, lag)
-         )
+         stats = self.rtstats.rows(date_id, time_id, station_id, type_m, 
+                                   tsText(tstamp), window_size, num_samples, 
+                                   nbytes, lag)
+      self.coalescer.append(row, stats, message[0])
 
 
    # -------------------------------
@@ -824,38 +2696,34 @@ class DBWritter(Lazy):
       '''
       station_id = self.lkStation(mqtt_id)
       if station_id == UNKNOWN_STATION_ID:
-         log.warn("Ignoring status message from unregistered station %s", 
-                  mqtt_id)
+         self.unregistered(mqtt_id, "status")
          return
       message = payload.split('\n')
       if len(message) != 4:
          log.error("Wrong average status message from station %s", mqtt_id)
          return
-      date_id, time_id, t0 = xtDateTime(message[1])
-
-      tstamp = t0.strftime("%Y-%m-%d %H:%M:%S")
+      date_id, time_id, tstamp = xtTimestamp(message[1], self.realtime.epoch)
       log.debug("Received average status message from station %s", mqtt_id)
 
       type_m = TYP_AVER
       row = self.realtime.row(date_id, time_id, station_id, type_m, tstamp, 
                               message[0])
-      self.__rtwrites += self.realtime.insert((row,))
-      if (self.__rtwrites % DBWritter.N_RT_WRITES) == 1:
-         log.info("RealTimeSamples rows written so far: %d" % self.__rtwrites)
 
       # Compute and store statistics
       # lag = measured lag MQTT[local] -  RPi[remote]
       # the timestamp reference is RPi[remote]
+      stats = ()
       if self.__stats:
+         _, _, t0      = xtDateTime(message[1])
          _, _, tOldest = xtDateTime(message[2])
          num_samples = int(message[3][1:-1])
          lag  = int(round((t1 - t0).total_seconds()))
          nbytes = len(payload)
          window_size = (t0 - tOldest).total_seconds()
-         self.rtstats.insert(
-            self.rtstats.rows(date_id, time_id, station_id, type_m, tstamp, 
-                              window_size, num_samples, nbytes, lag)
-         )
+         stats = self.rtstats.rows(date_id, time_id, station_id, type_m, 
+                                   tsText(tstamp), window_size, num_samples, 
+                                   nbytes, lag)
+      self.coalescer.append(row, stats, message[0])
 
 
    # ---------------------------------
@@ -866,25 +2734,114 @@ class DBWritter(Lazy):
       log.debug("Received averages history message from station %s", mqtt_id)
       station_id = self.lkStation(mqtt_id)
       if station_id == UNKNOWN_STATION_ID:
-         log.warn("Ignoring averags history message from unregistered station %s", 
-                  mqtt_id)
+         self.unregistered(mqtt_id, "averages history")
          return
-      rows = []
-      message = payload.split('\n')
-      msglen = len(message)
-      for i in range(0 , msglen/2):
-         date_id, time_id, t0 = xtDateTime(message[2*i+1])
-         tsmp = t0.strftime("%Y-%m-%d %H:%M:%S")
-         r = self.aver5min.row(date_id, time_id, station_id, tsmp, message[2*i])
-         rows.append(r)
-      commited = self.aver5min.insert(rows)
-      if self.__stats:
-         # Insert record into the statistics table
-         self.histats.insert(
-            self.histats.rows(station_id, TYP_AVER, len(rows), commited)
-         )
+      self.dumps.parse(self.aver5min, TYP_AVER, station_id, [payload])
+
+
 
+   # ---------------------------
+   # Process a batch of messages
+   # ---------------------------
 
+   def processMessages(self, messages):
+      '''
+      Process a batch of (kind, mqtt_id, payload, recv_tstamp) messages,
+      kind being 'minmax', 'averages', 'curstat' or 'avestat'.
+      Messages are grouped by kind and station, so that bulk dumps 
+      from a station are parsed at once, and all rows written are 
+      committed in a single unit of work. Errors are isolated per message:
+      every status message and every group of bulk dumps is processed
+      in a nested unit of work, so a failing one is logged and rolled 
+      back to its savepoint without discarding the rest of the batch.
+      '''
+      groups = collections.OrderedDict()
+      for kind, mqtt_id, payload, t1 in messages:
+         groups.setdefault((kind, mqtt_id), []).append((payload, t1))
+      with self.unit:
+         for (kind, mqtt_id), group in groups.iteritems():
+            log.debug("Received %d %s messages from station %s", 
+                      len(group), kind, mqtt_id)
+            if kind in DBWritter.DUMP_KINDS:
+               name, table, meas_type = DBWritter.DUMP_KINDS[kind]
+               station_id = self.lkStation(mqtt_id)
+               if station_id == UNKNOWN_STATION_ID:
+                  self.unregistered(mqtt_id, name)
+                  continue
+               try:
+                  with self.unit:
+                     self.dumps.parse(getattr(self, table), meas_type, 
+                                      station_id, 
+                                      [ payload for payload, _ in group ])
+               except Exception:
+                  log.exception("Error processing %s messages from station %s",
+                                name, mqtt_id)
+               continue
+            if kind == 'curstat':
+               process = self.processCurrentStatus
+            elif kind == 'avestat':
+               process = self.processAverageStatus
+            else:
+               log.error("Unknown %s message kind from station %s", 
+                         kind, mqtt_id)
+               continue
+            for payload, t1 in group:
+               try:
+                  with self.unit:
+                     process(mqtt_id, payload, t1)
+               except Exception:
+                  log.exception("Error processing %s message from station %s",
+                                kind, mqtt_id)
+         self.dumps.drain(wait=True)
+      self.partitions.prepare()
+
+   # -----------------------------------
+   # Parsed bulk dumps insertion callback
+   # -----------------------------------
+
+   def writeHistory(self, table, meas_type, station_id, rows):
+      '''Insert the rows parsed from a bulk dump and its statistics'''
+      # It seemd there is no need to sort the dates
+      # non-overlapping data do get written anyway 
+      #rows = sorted(rows, key=operator.itemgetter(0,1), reverse=True)
+      with self.unit:
+         self.calendar.check(rows)
+         commited = self.unit.stage(table, rows)
+         if self.__stats:
+            # Insert record into the statistics table
+            stats = self.histats.rows(station_id, meas_type, len(rows), 
+                                      commited)
+            self.calendar.check(stats)
+            self.unit.stage(self.histats, stats)
+
+   # -------------------------------------
+   # Write behind buffer flushing callback
+   # -------------------------------------
+
+   def writeRealTime(self, samples, stats, blocks=()):
+      '''
+      Write real time samples, their stats and blocks
+      in a single unit of work
+      '''
+      self.partitions.prepare(samples)
+      with self.unit:
+         self.calendar.check(samples)
+         if samples:
+            written = self.unit.stage(self.realtime, samples)
+            self.unit.onCommit(lambda: self.countWrites(written))
+         if stats:
+            self.unit.stage(self.rtstats, stats)
+         if blocks:
+            self.unit.stage(self.rtblocks, blocks)
+
+
+   def countWrites(self, written):
+      '''Count the RealTimeSamples rows committed, logging progress'''
+      N = DBWritter.N_RT_WRITES
+      before = self.__rtwrites
+      self.__rtwrites += written
+      if before // N != self.__rtwrites // N:
+         log.info("RealTimeSamples rows written so far: %d" % self.__rtwrites)
 
    # ----------------------------
    # Implement The Lazy interface 
@@ -896,11 +2853,54 @@ class DBWritter(Lazy):
       Write blocking behaviour.
       '''
       log.debug("work()")
-      if self.__purge:
-         date_id = self.datePurgeFrom()
-         if date_id:
-            self.realtime.delete(date_id)
-            self.rtstats.delete(date_id)
+      if self.__writer:
+         self.__writer.report()
+      self.submit(self.coalescer.report)
+      self.backup.report()
+
+   # --------------
+   # Server Control
+   # --------------
+
+   def stop(self):
+      '''Write pending jobs and rows and close the database'''
+      self.submit(self.close)
+      if self.__writer:
+         self.__writer.stop()
+         log.info("Database writter thread stopped")
+      self.dumps.stop()
+      self.backup.abort()
+
+
+   def close(self):
+      '''Flush pending rows and close the database'''
+      self.dumps.drain(wait=True)
+      self.coalescer.flush()
+      self.writebehind.flush()
+      self.__conn.close()
+      self.__conn = None
+      log.info("DBWritter stopped")
+
+   # ----------------------------
+   # SQLite performance profile
+   # ----------------------------
+
+   def tune(self, profile):
+      '''
+      Apply a sequence of (pragma, value) performance settings
+      to the current connection and log the resulting profile.
+      '''
+      for pragma, value in profile:
+         value = str(value)
+         if not SQLITE_PRAGMAS[pragma].match(value):
+            raise ValueError("Invalid %s value: %s" % (pragma, value))
+         self.__cursor.execute("PRAGMA %s = %s" % (pragma, value))
+         self.__cursor.fetchall()
+      current = []
+      for pragma, _ in profile:
+         self.__cursor.execute("PRAGMA %s" % pragma)
+         current.append("%s=%s" % (pragma, self.__cursor.fetchone()[0]))
+      log.info("SQLite profile: %s", ", ".join(current))
 
    # ------------------------------------
    # Dimensions SQL Lookup helper methods
@@ -916,12 +2916,36 @@ class DBWritter(Lazy):
 
 
    def lkStation(self, mqtt_id):
-      '''return station_id key from mqtt_id'''
-      self.__cursor.execute("SELECT station_id FROM Station WHERE mqtt_id=?",
-                            (mqtt_id,))
-      station_id = self.__cursor.fetchone() or (UNKNOWN_STATION_ID,)
-      log.verbose("lkStation(%s) => %s", mqtt_id, station_id)
-      return station_id[0]
+      '''return station_id key from mqtt_id, using the station registry'''
+      return self.__stations.get(mqtt_id, UNKNOWN_STATION_ID)
+
+
+   def loadStations(self):
+      '''
+      (Re)build the station registry from the Station dimension.
+      Both the registry and the unregistered stations cache 
+      are replaced at once.
+      '''
+      self.__cursor.execute("SELECT mqtt_id, station_id FROM Station")
+      stations = dict(self.__cursor.fetchall())
+      self.__stations, self.__unknown = stations, set()
+      log.info("Station registry loaded with %d stations", len(stations))
+
+
+   def unregistered(self, mqtt_id, kind):
+      '''
+      Log messages from unregistered stations.
+      Warns only the first time a given station is seen.
+      '''
+      if mqtt_id in self.__unknown:
+         log.verbose("Ignoring %s message from unregistered station %s",
+                     kind, mqtt_id)
+         return
+      if len(self.__unknown) >= DBWritter.MAX_UNKNOWN:
+         self.__unknown.clear()
+      self.__unknown.add(mqtt_id)
+      log.warn("Ignoring %s messages from unregistered station %s", 
+               kind, mqtt_id)
 
 
    def lkUnits(self, roof, aux):
@@ -931,17 +2955,3 @@ class DBWritter(Lazy):
       units_id = self.__cursor.fetchone() or (UNKNOWN_UNITS_ID,)
       log.verbose("lkUnits(roof=%s,aux=%s) => %s", roof, aux, units_id)
       return units_id[0]
-
-   # -------------------------------
-   # Facts SQL Loader helper methods
-   # -------------------------------
-
-   def datePurgeFrom(self):
-      '''Return date to purge from'''
-      now      = datetime.datetime.utcnow()
-      midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
-      delta    = datetime.timedelta(minutes=2*self.period)
-      if now - midnight < delta:
-         return now.year*10000 + now.month*100 +now.day
-      else:
-         return None
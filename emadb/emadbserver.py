@@ -50,12 +50,8 @@ class EMADBServer(Server):
     def __init__(self, options, **kargs):
         self.parseCmdLine(options)
         server.Server.__init__(self, **kargs)
-        self.__queue = {
-            'minmax':  [] ,
-            'curstat':  [] ,
-            'avestat':  [] ,
-            'averages': [] ,
-        }
+        # Messages held while paused
+        self.__held = []
         self.__parser = ConfigParser.ConfigParser()
         self.__parser.optionxform = str
         self.__parser.read(self.__cfgfile)
@@ -103,7 +99,7 @@ class EMADBServer(Server):
         self.__parser.read(self.__cfgfile)
         log.setLevel(self.__parser.get("GENERIC", "generic_log"))
         self.mqttclient.reload()
-        self.dbwritter.reload()
+        self.dbwritter.submit(self.dbwritter.reload)
         log.info("===============")
         log.info("RELOAD COMPLETE")
         log.info("===============")
@@ -128,59 +124,33 @@ class EMADBServer(Server):
     # -------------
 
     def flush(self):
-        '''Flushes queues, sending messages to destination'''
-        while len(self.__queue['minmax']):
-            item = self.__queue['minmax'].pop(0)
-            self.dbwritter.processMinMax(item[0], item[1])
-        while len(self.__queue['curstat']):
-            item = self.__queue['curstat'].pop(0)
-            self.dbwritter.processCurrentStatus(item[0], item[1], item[2])
-        while len(self.__queue['avestat']):
-            item = self.__queue['avestat'].pop(0)
-            self.dbwritter.processAverageStatus(item[0], item[1], item[2])
-        while len(self.__queue['averages']):
-            item = self.__queue['averages'].pop(0)
-            self.dbwritter.processSamples(item[0], item[1])
+        '''Sends held messages to destination as a single batch'''
+        if self.__held:
+            batch, self.__held = self.__held, []
+            self.dbwritter.submit(self.dbwritter.processMessages, batch)
 
-    def onMinMaxMessage(self, mqtt_id, payload):
-        self.__queue['minmax'].append((mqtt_id, payload))
+    def onMessages(self, batch):
+        '''
+        Send a batch of (kind, mqtt_id, payload, recv_tstamp) messages
+        read from MQTT in a single socket wakeup, or hold it if paused.
+        '''
+        self.__held.extend(batch)
         if self.paused:
-            log.warning("Holding %d minmax messages on queue",
-                        len(self.__queue['minmax']))
+            log.warning("Holding %d messages on queue", len(self.__held))
             return
-        while len(self.__queue['minmax']):
-            item = self.__queue['minmax'].pop(0)
-            self.dbwritter.processMinMax(item[0], item[1])
+        self.flush()
+
+    def onMinMaxMessage(self, mqtt_id, payload):
+        self.onMessages([('minmax', mqtt_id, payload, None)])
 
     def onCurrentStatusMessage(self, mqtt_id, payload, recv_tstamp):
-        self.__queue['curstat'].append((mqtt_id, payload, recv_tstamp))
-        if self.paused:
-            log.warning("Holding %d current status messages on queue",
-                        len(self.__queue['curstat']))
-            return
-        while len(self.__queue['curstat']):
-            item = self.__queue['curstat'].pop(0)
-            self.dbwritter.processCurrentStatus(item[0], item[1], item[2])
+        self.onMessages([('curstat', mqtt_id, payload, recv_tstamp)])
 
     def onAverageStatusMessage(self, mqtt_id, payload, recv_tstamp):
-        self.__queue['avestat'].append((mqtt_id, payload, recv_tstamp))
-        if self.paused:
-            log.warning("Holding %d average status messages on queue",
-                        len(self.__queue['avestat']))
-            return
-        while len(self.__queue['avestat']):
-            item = self.__queue['avestat'].pop(0)
-            self.dbwritter.processAverageStatus(item[0], item[1], item[2])
+        self.onMessages([('avestat', mqtt_id, payload, recv_tstamp)])
 
     def onAveragesHistoryMessage(self, mqtt_id, payload):
-        self.__queue['averages'].append((mqtt_id, payload))
-        if self.paused:
-            log.warning("Holding %d averages messages on queue", 
-                        len(self._queue['averages']))
-            return
-        while len(self.__queue['averages']):
-            item = self.__queue['averages'].pop(0)
-            self.dbwritter.processAveragesHistory(item[0], item[1])
+        self.onMessages([('averages', mqtt_id, payload, None)])
                 
     # --------------
     # Server Control
@@ -188,6 +158,7 @@ class EMADBServer(Server):
 
     def stop(self):
         log.info("Shutting down EMA server")
+        self.dbwritter.stop()
         logging.shutdown()
 
 
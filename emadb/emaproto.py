@@ -99,7 +99,10 @@ MTPRO = 'p'                     # Average of N cuurent messages (type=a)
 # Timestamp format, the EMA way
 STRFTIME = "(%H:%M:%S %d/%m/%Y)"
 
+import sys
 import math
+import array
+import struct
 
 def encodeFreq(hertz):
     '''Encode frequency in Hertz into EMA format field'''
@@ -153,3 +156,159 @@ def magnitude(frequency):
    else:
       mv = MAG_CLIP_VALUE
    return round(mv,1)
+
+
+# --------------------------------------------------------------------
+# Status message layout, as a table of
+# (field name, begin offset, end offset, scale factor)
+# in EMA message order. Field names match the database column names.
+# Scale factor meaning:
+#   None  => character field, returned as is
+#   FREQ  => EMMMM encoded frequency field
+#   INT   => integer field
+#   other => numeric field, divided by scale
+# --------------------------------------------------------------------
+
+FREQ = 'freq'
+INT  = 'int'
+
+STATUS_LAYOUT = (
+   ('roof_relay',     SRRB, SRRE, None),
+   ('aux_relay',      SARB, SARE, None),
+   ('voltage',        SPSB, SPSE, 10),
+   ('wet',            SRAB, SRAE, 10),
+   ('cloudy',         SCLB, SCLE, 10),
+   ('cal_pressure',   SCBB, SCBE, 10),
+   ('abs_pressure',   SABB, SABE, 10),
+   ('rain',           SPCB, SPCE, 10),
+   ('irradiation',    SPYB, SPYE, 10),
+   ('frequency',      SPHB, SPHE, FREQ),
+   ('temperature',    SATB, SATE, 10),
+   ('rel_humidity',   SRHB, SRHE, 10),
+   ('dew_point',      SDPB, SDPE, 10),
+   ('wind_speed10m',  SAAB, SAAE, 1),
+   ('wind_speed',     SACB, SACE, 10),
+   ('wind_direction', SWDB, SWDE, INT),
+   ('msg_type',       SMTB, SMTE, None),
+)
+
+def statusLayout(lag=LAG):
+   '''
+   Returns the status message layout for a given protocol lag.
+   Every offset past the power supply field begin is shifted.
+   '''
+   if lag == LAG:
+      return STATUS_LAYOUT
+   shift = lag - LAG
+   return tuple(
+      (name, 
+       begin + shift if begin > SPSB else begin, 
+       end   + shift if end   > SPSB else end, 
+       scale) for name, begin, end, scale in STATUS_LAYOUT 
+   )
+
+def decodeColumn(values, scale):
+   '''
+   Convert the values of a status message field into a column.
+   Values are strings for character fields and the raw integer 
+   values sent by EMA for the rest. Numeric columns are returned as 
+   array.array('d') objects, INT columns as array.array('i') objects
+   and character fields as lists of strings.
+   '''
+   if scale is None:
+      return list(values)
+   if scale == FREQ:
+      return array.array('d', [ decodeFreq("%05d" % x) for x in values ])
+   if scale == INT:
+      return array.array('i', values)
+   if scale == 1:
+      return array.array('d', values)
+   return array.array('d', [ float(x) / scale for x in values ])
+
+def decodeStatusBatch(lines, lag=LAG):
+   '''
+   Decode a list of status messages, slicing and converting every 
+   field once for the whole list.
+   Returns a dictionary of columns keyed by field name, as made by 
+   decodeColumn(). The 'vis_magnitude' column is derived from the 
+   'frequency' column.
+   '''
+   columns = {}
+   for name, begin, end, scale in statusLayout(lag):
+      raw = [ line[begin:end] for line in lines ]
+      if scale is not None:
+         raw = map(int, raw)
+      columns[name] = decodeColumn(raw, scale)
+   columns['vis_magnitude'] = array.array('d', 
+                                 map(magnitude, columns['frequency']))
+   return columns
+
+
+# --------------------------------------------------------------------
+# Status blocks: the status messages of a station and minute packed
+# into a binary string, made of a version byte, the number of samples
+# (2 bytes) and their offsets in seconds from the block minute 
+# (1 signed byte each), followed by one fixed width array per field 
+# in status layout order (message type excluded). All little endian.
+# Character fields take 1 byte per sample, the frequency keeps its 
+# EMMMM encoding in 4 bytes and every other field its raw integer 
+# value as sent by EMA (i.e. tenths) in 2 bytes.
+# --------------------------------------------------------------------
+
+BLOCK_VERSION = 1
+BLOCK_HEADER  = '<BH'
+
+def blockTypecode(scale):
+   '''array typecode of a field in a status block'''
+   if scale is None:
+      return 'c'
+   if scale == FREQ:
+      return 'i'
+   return 'h'
+
+def encodeStatusBlock(offsets, lines, lag=LAG):
+   '''
+   Pack a list of status messages and their offsets in seconds 
+   from the block minute into a status block string.
+   '''
+   parts = [array.array('b', offsets)]
+   for name, begin, end, scale in statusLayout(lag):
+      if name == 'msg_type':
+         continue
+      raw = [ line[begin:end] for line in lines ]
+      if scale is None:
+         parts.append(array.array('c', ''.join(raw)))
+      else:
+         parts.append(array.array(blockTypecode(scale), map(int, raw)))
+   if sys.byteorder == 'big':
+      for part in parts:
+         part.byteswap()
+   return (struct.pack(BLOCK_HEADER, BLOCK_VERSION, len(lines)) + 
+           ''.join(part.tostring() for part in parts))
+
+def decodeStatusBlock(block):
+   '''
+   Unpack a status block string.
+   Returns the same columns as decodeStatusBatch() does, but for
+   'msg_type', plus the 'offset' column as an array.array('i') object.
+   '''
+   block = str(block)
+   version, n = struct.unpack_from(BLOCK_HEADER, block)
+   if version != BLOCK_VERSION:
+      raise ValueError("Unknown status block version %d" % version)
+   pos     = struct.calcsize(BLOCK_HEADER)
+   columns = {}
+   fields  = [ ('offset', 'b', INT) ] + [ 
+      (name, blockTypecode(scale), scale) 
+      for name, _, _, scale in STATUS_LAYOUT if name != 'msg_type' ]
+   for name, typecode, scale in fields:
+      raw  = array.array(typecode)
+      size = raw.itemsize * n
+      raw.fromstring(block[pos:pos+size])
+      pos += size
+      if sys.byteorder == 'big':
+         raw.byteswap()
+      columns[name] = decodeColumn(raw, scale)
+   columns['vis_magnitude'] = array.array('d', 
+                                 map(magnitude, columns['frequency']))
+   return columns
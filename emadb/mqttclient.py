@@ -23,8 +23,10 @@
 
 # ========================== DESIGN NOTES ==============================
 # MQTT Subscriber object specific to EMA weather stations
-# Delivers the three kind of messages expected to its parent server
-# which will delegate them to the back-end dbwritter object
+# Delivers the four kind of messages expected to its parent server
+# which will delegate them to the back-end dbwritter object.
+# Messages read in a single socket wakeup are delivered as one batch
+# of (kind, station id, payload, timestamp) tuples.
 # ======================================================================
 
 import logging
@@ -32,20 +34,32 @@ log = logging.getLogger('mqtt')
 
 from mqttsubscriber import MQTTGenericSubscriber
 
+# Message kinds by topic suffix
+KINDS = (
+   ("history/minmax",  'minmax'),
+   ("history/average", 'averages'),
+   ("current/status",  'curstat'),
+   ("average/status",  'avestat'),
+)
+
 class MQTTClient(MQTTGenericSubscriber):
 
 
    def onMessage(self, msg, tstamp):
-      log.debug("Received message on topic = %s, QoS = %d, retain = %s",
-                msg.topic, msg.qos, msg.retain)
-      id = msg.topic.split('/')[1]
-      if msg.topic.endswith("history/minmax"):
-         self.srv.onMinMaxMessage(id, msg.payload)
-      elif msg.topic.endswith("history/average"):
-         self.srv.onAveragesHistoryMessage(id, msg.payload)
-      elif msg.topic.endswith("current/status"):
-         self.srv.onCurrentStatusMessage(id, msg.payload, tstamp)
-      elif msg.topic.endswith("average/status"):
-         self.srv.onAverageStatusMessage(id, msg.payload, tstamp)
-      else:
-         log.warn("message received on unexpected topic %s", msg.topic)
+      self.onMessages([(msg, tstamp)])
+
+
+   def onMessages(self, batch):
+      messages = []
+      for msg, tstamp in batch:
+         log.debug("Received message on topic = %s, QoS = %d, retain = %s",
+                   msg.topic, msg.qos, msg.retain)
+         for suffix, kind in KINDS:
+            if msg.topic.endswith(suffix):
+               id = msg.topic.split('/')[1]
+               messages.append((kind, id, msg.payload, tstamp))
+               break
+         else:
+            log.warn("message received on unexpected topic %s", msg.topic)
+      if messages:
+         self.srv.onMessages(messages)
@@ -34,11 +34,17 @@
 # The work() procedure executes twice as fast as 
 # the keepalive timeout specidied to the client MQTT library.
 #
+# On every select() wakeup, onInput() keeps on reading packets while 
+# the socket has data, up to a batch limit, and delivers the messages 
+# read as a single batch to onMessages(). This saves a select() round 
+# per packet under bursts, like stations dumping history at hh:00.
+#
 # ======================================================================
 
 import logging
 import paho.mqtt.client as paho
 import socket
+import select
 import datetime
 from   abc import ABCMeta, abstractmethod
 
@@ -69,7 +75,7 @@ def on_disconnect(client, userdata, rc):
 # Callback when a PUBLISH message is received from the server.
 # The default message callback
 def on_message(client, userdata, msg):
-   userdata.onMessage(msg, datetime.datetime.utcnow())
+   userdata.onReceive(msg, datetime.datetime.utcnow())
 
 # Callback subscriptions
 def on_subscribe(client, userdata, mid, granted_qos):
@@ -89,6 +95,7 @@ class MQTTGenericSubscriber(Lazy):
       self.srv        = srv
       self.__state    = NOT_CONNECTED
       self.__topics   = []
+      self.__batch    = None
       srv.addLazy(self)
       # We do not allow to reconfigure an existing connection
       # to a broker as we would loose incoming data
@@ -106,13 +113,15 @@ class MQTTGenericSubscriber(Lazy):
       log.info("MQTT client created")
 
 
-      # we only allow to reconfigure the topic list and keepalive period
+      # we only allow to reconfigure the topic list, keepalive period
+      # and batch limit
    def reload(self):
       '''Reloads and reconfigures itself'''
       parser = self.__parser    # shortcut
       lvl             = parser.get("MQTT", "mqtt_log")
       log.setLevel(lvl)
       self.__keepalive  = parser.getint("MQTT", "mqtt_period")
+      self.__max_batch  = max(1, parser.getint("MQTT", "mqtt_batch"))
       self.__initial_T  = self.__keepalive / 2
       self.__period     = self.__initial_T
       self.setPeriod(self.__initial_T )
@@ -148,6 +157,14 @@ class MQTTGenericSubscriber(Lazy):
        log.warning("Recovered from mqtt library 'double disconnection' bug")
 
 
+   def onReceive(self, msg, tstamp):
+      '''Gather the messages read in a single onInput() call'''
+      if self.__batch is None:
+         self.onMessages([(msg, tstamp)])
+      else:
+         self.__batch.append((msg, tstamp))
+
+
    @abstractmethod
    def onMessage(self, msg, tstamp):
       '''
@@ -158,6 +175,15 @@ class MQTTGenericSubscriber(Lazy):
       pass
 
 
+   def onMessages(self, batch):
+      '''
+      Process a batch of (message, timestamp) pairs read in a single
+      onInput() call. Calls onMessage() for each one by default.
+      '''
+      for msg, tstamp in batch:
+         self.onMessage(msg, tstamp)
+
+
    def onSubscribe(self, mid, granted_qos):
      log.info("Subscriptions ok with MID = %s, granted QoS = %s",
                mid, granted_qos)
@@ -172,10 +198,34 @@ class MQTTGenericSubscriber(Lazy):
 
    def onInput(self):
       '''
-      Read from message buffer and notify handlers if message complete.
+      Read packets while there is data available, up to the batch limit,
+      and deliver the complete messages read as a single batch.
       Called from Server object
       '''
-      self.paho.loop_read()
+      self.__batch = []
+      packets = 0
+      try:
+         while packets < self.__max_batch:
+            packets += 1
+            if self.paho.loop_read() != paho.MQTT_ERR_SUCCESS:
+               break
+            if not self.pending():
+               break
+      finally:
+         batch, self.__batch = self.__batch, None
+      log.verbose("Read %d packets, %d messages", packets, len(batch))
+      if batch:
+         self.onMessages(batch)
+
+
+   def pending(self):
+      '''True if the socket can be read without blocking'''
+      sock = self.paho.socket()
+      if sock is None:
+         return False
+      if hasattr(sock, 'pending') and sock.pending():
+         return True      # SSL buffered data, invisible to select()
+      return bool(select.select([sock], [], [], 0)[0])
    
    def fileno(self):
       '''Implement this interface to be added in select() system call'''
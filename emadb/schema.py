@@ -25,10 +25,12 @@
 
 import sys
 import os
+import re
 import json
 import logging
 import datetime
 import sqlite3
+import hashlib
 
 # ----------------
 # Module Constants
@@ -36,6 +38,22 @@ import sqlite3
 
 UNKNOWN = 'Unknown'
 
+# Measurements given in tenths by EMA, which may be stored 
+# as scaled integers instead of REAL values
+TENTHS_COLUMNS = ('voltage', 'wet', 'cloudy', 'cal_pressure', 'abs_pressure',
+                  'rain', 'irradiation', 'temperature', 'rel_humidity', 
+                  'dew_point', 'wind_speed')
+
+# Fact tables with measurement columns, with a <name>View view
+MEASUREMENT_TABLES = ('MinMaxHistory', 'RealTimeSamples', 'AveragesHistory')
+
+# PRAGMA auto_vacuum values
+AUTO_VACUUM = { 'NONE': 0, 'FULL': 1, 'INCREMENTAL': 2 }
+
+# Schema version stored in PRAGMA user_version
+# Any change forces a complete schema generation
+SCHEMA_VERSION = 2
+
 # -----------------------
 # Module Global Variables
 # -----------------------
@@ -54,6 +72,89 @@ def julian_day(date):
     m = date.month + 12*a - 3
     return date.day + ((153*m + 2)//5) + 365*y + y//4 - y//100 + y//400 - 32045
 
+def rowidClause(without_rowid):
+    '''Table options clause selecting the fact tables storage layout'''
+    return " WITHOUT ROWID" if without_rowid else ""
+
+def tenthsType(scaled):
+    '''Column type of measurements given in tenths'''
+    return "INTEGER" if scaled else "REAL"
+
+def timestampType(epoch):
+    '''Column type of fact tables timestamps'''
+    return "INTEGER" if epoch else "TEXT"
+
+def columnType(connection, name, column, schema='main'):
+    '''Declared type of a table column or None'''
+    for info in connection.execute("PRAGMA %s.table_info(%s)" % (schema, name)):
+        if info[1] == column:
+            return info[2].upper()
+    return None
+
+def isScaled(connection, name, schema='main'):
+    '''True if a fact table stores tenths as scaled integers'''
+    return columnType(connection, name, 'temperature', schema) == 'INTEGER'
+
+def isEpoch(connection, name, schema='main'):
+    '''True if a fact table stores timestamps as seconds since epoch'''
+    return columnType(connection, name, 'timestamp', schema) == 'INTEGER'
+
+def viewColumn(name, declared):
+    '''View expression presenting a fact table column in its usual form'''
+    if declared.upper() != 'INTEGER':
+        return name
+    if name in TENTHS_COLUMNS:
+        return "%s / 10.0 AS %s" % (name, name)
+    if name == 'timestamp':
+        return "datetime(timestamp, 'unixepoch') AS timestamp"
+    return name
+
+def realView(connection, name):
+    '''
+    (Re)create the <name>View view of a fact table, presenting 
+    measurements in tenths as REAL values and timestamps as 
+    'YYYY-MM-DD HH:MM:SS' strings whatever the table encoding.
+    '''
+    columns = [ viewColumn(c[1], c[2])
+                for c in connection.execute("PRAGMA main.table_info(%s)" % name) ]
+    connection.execute("DROP VIEW IF EXISTS %sView" % name)
+    connection.execute("CREATE VIEW %sView AS SELECT %s FROM main.%s" % 
+                       (name, ', '.join(columns), name))
+
+def stationIndex(cursor, table, columns, enabled):
+    '''
+    Create or drop the optional station-first index on a fact table,
+    for queries on a single station over a date range.
+    '''
+    if enabled:
+        log.info("Creating %s station index if not exists", table)
+        cursor.execute("CREATE INDEX IF NOT EXISTS %s_station_idx ON %s(%s)" % 
+                       (table, table, ', '.join(columns)))
+    else:
+        cursor.execute("DROP INDEX IF EXISTS %s_station_idx" % table)
+
+def autoVacuum(connection, mode):
+    '''
+    Set the auto_vacuum mode (NONE, FULL or INCREMENTAL). 
+    It only takes effect after a VACUUM, which is done here 
+    for a database without tables yet (also needed in WAL mode).
+    Returns True if the mode is in effect.
+    '''
+    mode = mode.upper()
+    if mode not in AUTO_VACUUM:
+        raise ValueError("Invalid auto_vacuum value: %s" % mode)
+    connection.execute("PRAGMA auto_vacuum = %s" % mode)
+    current = connection.execute("PRAGMA auto_vacuum").fetchone()[0]
+    if current != AUTO_VACUUM[mode] and \
+       not connection.execute("SELECT count(*) FROM sqlite_master").fetchone()[0]:
+        connection.execute("VACUUM")
+        current = connection.execute("PRAGMA auto_vacuum").fetchone()[0]
+    return current == AUTO_VACUUM[mode]
+
+def digest(rows):
+    '''Signature of a list of rows to detect dimension data changes'''
+    return hashlib.md5(json.dumps(rows, sort_keys=True)).hexdigest()
+
 def fromJSON(file_path, default_var):
     '''Read pre-populated JSON data from a file'''
     lines = []
@@ -216,6 +317,75 @@ DEFAULT_STATIONS = [
 ]
 
 
+# ============================================================================ #
+#                               SCHEMA INFO TABLE
+# ============================================================================ #
+
+class SchemaInfo(object):
+    '''
+    Records a signature of the parameters and data each schema 
+    component was last generated with, so that unchanged components
+    are not generated again on every startup and reload.
+    '''
+
+    def __init__(self, conn):
+        '''Create the SQLite SchemaInfo Table'''
+        self.__cursor  = conn.cursor()
+        self.__conn  = conn
+
+
+    def generate(self):
+        self.table()
+        if self.version() != SCHEMA_VERSION:
+            log.info("Schema version changed, generating all components")
+            self.__cursor.execute("DELETE FROM SchemaInfo")
+        self.__conn.commit()
+
+
+    def table(self):
+        '''Create the SQLite SchemaInfo table'''
+        self.__cursor.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS SchemaInfo
+            (
+            component          TEXT PRIMARY KEY,
+            signature          TEXT,
+            timestamp          TEXT DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+
+    # --------------
+    # Helper methods
+    # --------------
+
+    def version(self):
+        '''Schema version of the database file'''
+        return self.__cursor.execute("PRAGMA user_version").fetchone()[0]
+
+
+    def stamp(self):
+        '''Mark the database file with the current schema version'''
+        self.__cursor.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.__conn.commit()
+
+
+    def signature(self, component):
+        '''Signature a component was last generated with, or None'''
+        row = self.__cursor.execute(
+            "SELECT signature FROM SchemaInfo WHERE component = ?",
+            (component,)).fetchone()
+        return row and row[0]
+
+
+    def update(self, component, signature):
+        '''Record the signature a component has been generated with'''
+        self.__cursor.execute(
+            "INSERT OR REPLACE INTO SchemaInfo (component, signature) VALUES (?,?)", 
+            (component, signature))
+        self.__conn.commit()
+
+
 # ============================================================================ #
 #                               DATE TABLE (DIMENSION)
 # ============================================================================ #
@@ -237,6 +407,10 @@ class Date(object):
         self.populate(replace)
         self.__conn.commit()
 
+    def signature(self):
+        '''Parameters the table is generated with'''
+        return json.dumps([self.__fmt, self.__start.year, self.__end.year])
+
     def table(self):
         '''Create the SQLite Date Table'''
         log.info("Creating Date Table if not exists")
@@ -299,6 +473,21 @@ class Date(object):
         )
 
 
+    def month(self, year, month, commit=True):
+        '''Insert a whole month on demand, if not already there'''
+        log.info("Adding %04d-%02d to Date Table", year, month)
+        date = datetime.date(year, month, 1)
+        dates = []
+        while date.month == month:
+            dates.append(self.row(date))
+            date = date + Date.ONE
+        self.__cursor.executemany(
+            "INSERT OR IGNORE INTO Date VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            dates)
+        if commit:
+            self.__conn.commit()
+
+
     def rows(self):
         '''Generate a list of rows to inject into the table'''
         date = self.__start
@@ -346,6 +535,11 @@ class TimeOfDay(object):
         self.__conn.commit()
 
 
+    def signature(self):
+        '''Digest of the table contents'''
+        return digest(self.rows())
+
+
     def table(self):
         '''Create the SQLite Time of Day table'''
         log.info("Creating Time Table if not exists")
@@ -430,6 +624,11 @@ class Station(object):
         self.__conn.commit()
 
 
+    def signature(self):
+        '''Digest of the table contents'''
+        return digest(self.rows())
+
+
     def table(self):
         '''Create the SQLite Station table'''
         log.info("Creating Station Table if not exists")
@@ -494,6 +693,11 @@ class MeasurementType(object):
         self.__conn.commit()
 
 
+    def signature(self):
+        '''Digest of the table contents'''
+        return digest(self.rows())
+
+
     def table(self):
         '''Create the SQLite Measurement Type table'''
         log.info("Creating Type Table if not exists")
@@ -559,6 +763,11 @@ class Units(object):
         self.__conn.commit()
 
 
+    def signature(self):
+        '''Digest of the table contents'''
+        return digest(self.rows())
+
+
     def table(self):
         '''Create the SQLite Units table'''
         log.info("Creating Units Table if not exists")
@@ -623,12 +832,20 @@ class MinMaxHistory(object):
         self.__conn  = conn
 
 
-    def generate(self):
-        self.table()
+    def generate(self, station_index=False, without_rowid=False, scaled=False,
+                 epoch=False):
+        self.table(without_rowid=without_rowid, scaled=scaled, epoch=epoch)
+        self.index(station_index)
         self.__conn.commit()
 
 
-    def table(self):
+    def index(self, enabled):
+        '''Create or drop the station-first index'''
+        stationIndex(self.__cursor, 'MinMaxHistory', 
+                     ('station_id', 'date_id', 'time_id', 'type_id'), enabled)
+
+
+    def table(self, without_rowid=False, scaled=False, epoch=False):
         '''Create the SQLite MinMaxHistory table'''
         log.info("Creating MinMaxHistory Table if not exists")
         self.__cursor.executescript(
@@ -640,25 +857,27 @@ class MinMaxHistory(object):
             station_id         INTEGER NOT NULL REFERENCES Station(station_id),
             type_id            INTEGER NOT NULL REFERENCES Type(type_id),
             units_id           INTEGER NOT NULL REFERENCES Units(units_id),
-            voltage            REAL,
-            wet                REAL,
-            cloudy             REAL,
-            cal_pressure       REAL,
-            abs_pressure       REAL,
-            rain               REAL,
-            irradiation        REAL,
+            voltage            %(tenths)s,
+            wet                %(tenths)s,
+            cloudy             %(tenths)s,
+            cal_pressure       %(tenths)s,
+            abs_pressure       %(tenths)s,
+            rain               %(tenths)s,
+            irradiation        %(tenths)s,
             vis_magnitude      REAL,
             frequency          REAL,
-            temperature        REAL,
-            rel_humidity       REAL,
-            dew_point          REAL,
-            wind_speed         REAL,
+            temperature        %(tenths)s,
+            rel_humidity       %(tenths)s,
+            dew_point          %(tenths)s,
+            wind_speed         %(tenths)s,
             wind_speed10m      REAL,
             wind_direction     INTEGER,
-            timestamp          TEXT,
+            timestamp          %(tstamp)s,
             PRIMARY KEY (date_id, time_id, station_id, type_id)
-            );
-            """
+            )%(options)s;
+            """ % { 'options': rowidClause(without_rowid), 
+                    'tenths': tenthsType(scaled),
+                    'tstamp': timestampType(epoch) }
         )
 
 
@@ -667,6 +886,10 @@ class MinMaxHistory(object):
 # ============================================================================ #
 
 class RealTimeSamples(object):
+
+    # Per-day partition file name and attached database name
+    PARTITION_FILE   = "RealTimeSamples_%08d.db"
+    PARTITION_SCHEMA = "rts_%08d"
     
     def __init__(self, conn):
         '''Create the SQLite RealTimeSamples Table'''
@@ -674,44 +897,117 @@ class RealTimeSamples(object):
         self.__conn  = conn
 
 
-    def generate(self):
-        self.table()
+    def generate(self, station_index=False, without_rowid=False, scaled=False,
+                 epoch=False):
+        self.table(without_rowid=without_rowid, scaled=scaled, epoch=epoch)
+        self.index(station_index)
         self.__conn.commit()
 
 
-    def table(self):
-        '''Create the SQLite Units table'''
+    def index(self, enabled):
+        '''Create or drop the station-first index'''
+        stationIndex(self.__cursor, 'RealTimeSamples', 
+                     ('station_id', 'date_id', 'time_id', 'type_id'), enabled)
+
+
+    def table(self, schema='main', without_rowid=False, scaled=False,
+              epoch=False):
+        '''Create the SQLite RealTimeSamples table in a given database'''
         log.info("Creating RealTimeSamples Table if not exists")
         self.__cursor.executescript(
             """
-            CREATE TABLE IF NOT EXISTS RealTimeSamples
+            CREATE TABLE IF NOT EXISTS %(schema)s.RealTimeSamples
             (
             date_id            INTEGER NOT NULL REFERENCES Date(date_id), 
             time_id            INTEGER NOT NULL REFERENCES Time(time_id), 
             station_id         INTEGER NOT NULL REFERENCES Station(station_id),
             type_id            INTEGER NOT NULL REFERENCES Type(type_id),
             units_id           INTEGER NOT NULL REFERENCES Units(units_id),
-            voltage            REAL,
-            wet                REAL,
-            cloudy             REAL,
-            cal_pressure       REAL,
-            abs_pressure       REAL,
-            rain               REAL,
-            irradiation        REAL,
+            voltage            %(tenths)s,
+            wet                %(tenths)s,
+            cloudy             %(tenths)s,
+            cal_pressure       %(tenths)s,
+            abs_pressure       %(tenths)s,
+            rain               %(tenths)s,
+            irradiation        %(tenths)s,
             vis_magnitude      REAL,
             frequency          REAL,
-            temperature        REAL,
-            rel_humidity       REAL,
-            dew_point          REAL,
-            wind_speed         REAL,
+            temperature        %(tenths)s,
+            rel_humidity       %(tenths)s,
+            dew_point          %(tenths)s,
+            wind_speed         %(tenths)s,
             wind_speed10m      REAL,
             wind_direction     INTEGER,
-            timestamp          TEXT,
+            timestamp          %(tstamp)s,
             PRIMARY KEY (date_id, time_id, station_id, type_id)
-            );
-            """
+            )%(options)s;
+            """ % { 'schema': schema, 'options': rowidClause(without_rowid),
+                    'tenths': tenthsType(scaled),
+                    'tstamp': timestampType(epoch) }
         )
 
+    # -----------------------
+    # Per-day partition files
+    # -----------------------
+
+    def attach(self, directory, date_id, without_rowid=False, scaled=False,
+               epoch=False):
+        '''
+        Attach the partition file for a given date_id, creating it 
+        and its RealTimeSamples table if needed.
+        Returns the attached database name.
+        '''
+        name = RealTimeSamples.PARTITION_SCHEMA % date_id
+        path = os.path.join(directory, RealTimeSamples.PARTITION_FILE % date_id)
+        log.info("Attaching partition %s as %s", path, name)
+        self.__cursor.execute("ATTACH DATABASE ? AS %s" % name, (path,))
+        self.table(name, without_rowid, scaled, epoch)
+        self.__conn.commit()
+        return name
+
+
+    def attachAll(self, directory, limit=10):
+        '''
+        Attach the existing partition files in a directory, up to the
+        newest limit ones, and join them into the RealTimeSamples view.
+        For SQLite clients other than the service, which otherwise 
+        see the main table only. Returns the attached database names.
+        '''
+        dates = sorted(int(name[16:24]) for name in os.listdir(directory)
+                       if re.match(r'^RealTimeSamples_\d{8}\.db$', name))
+        names = []
+        for date_id in dates[-limit:]:
+            name = RealTimeSamples.PARTITION_SCHEMA % date_id
+            path = os.path.join(directory, 
+                                RealTimeSamples.PARTITION_FILE % date_id)
+            self.__cursor.execute("ATTACH DATABASE ? AS %s" % name, (path,))
+            names.append(name)
+        self.view(names)
+        return names
+
+
+    def detach(self, name):
+        '''Detach a partition file, dropping its rollups trigger if any'''
+        log.info("Detaching partition %s", name)
+        self.__cursor.execute("DROP TRIGGER IF EXISTS temp.%s_rollup" % name)
+        self.__cursor.execute("DETACH DATABASE %s" % name)
+
+
+    def view(self, names):
+        '''
+        (Re)create the TEMP RealTimeSamples view joining the main table
+        and the given partitions, which shadows the main table for
+        this connection. No view is created without partitions.
+        '''
+        self.__cursor.execute("DROP VIEW IF EXISTS temp.RealTimeSamples")
+        if names:
+            selects = ["SELECT * FROM main.RealTimeSamples"] + [
+                "SELECT * FROM %s.RealTimeSamples" % name for name in names ]
+            self.__cursor.execute(
+                "CREATE TEMP VIEW RealTimeSamples AS " + 
+                " UNION ALL ".join(selects))
+        self.__conn.commit()
+
 # ============================================================================ #
 #                   AVERAGES HISTORY TABLE (PERIODIC SNAPSHOT FACT)
 # ============================================================================ #
@@ -724,12 +1020,20 @@ class AveragesHistory(object):
         self.__conn  = conn
 
 
-    def generate(self):
-        self.table()
+    def generate(self, station_index=False, without_rowid=False, scaled=False,
+                 epoch=False):
+        self.table(without_rowid=without_rowid, scaled=scaled, epoch=epoch)
+        self.index(station_index)
         self.__conn.commit()
 
 
-    def table(self):
+    def index(self, enabled):
+        '''Create or drop the station-first index'''
+        stationIndex(self.__cursor, 'AveragesHistory', 
+                     ('station_id', 'date_id', 'time_id'), enabled)
+
+
+    def table(self, without_rowid=False, scaled=False, epoch=False):
         '''Create the SQLite AveragesHistory table'''
         log.info("Creating AveragesHistory Table if not exists")
         self.__cursor.executescript(
@@ -740,25 +1044,27 @@ class AveragesHistory(object):
             time_id            INTEGER NOT NULL REFERENCES Time(time_id), 
             station_id         INTEGER NOT NULL REFERENCES Station(station_id),
             units_id           INTEGER NOT NULL REFERENCES Units(units_id),
-            voltage            REAL,
-            wet                REAL,
-            cloudy             REAL,
-            cal_pressure       REAL,
-            abs_pressure       REAL,
-            rain               REAL,
-            irradiation        REAL,
+            voltage            %(tenths)s,
+            wet                %(tenths)s,
+            cloudy             %(tenths)s,
+            cal_pressure       %(tenths)s,
+            abs_pressure       %(tenths)s,
+            rain               %(tenths)s,
+            irradiation        %(tenths)s,
             vis_magnitude      REAL,
             frequency          REAL,
-            temperature        REAL,
-            rel_humidity       REAL,
-            dew_point          REAL,
-            wind_speed         REAL,
+            temperature        %(tenths)s,
+            rel_humidity       %(tenths)s,
+            dew_point          %(tenths)s,
+            wind_speed         %(tenths)s,
             wind_speed10m      REAL,
             wind_direction     INTEGER,
-            timestamp          TEXT,
+            timestamp          %(tstamp)s,
             PRIMARY KEY (date_id, time_id, station_id)
-            );
-            """
+            )%(options)s;
+            """ % { 'options': rowidClause(without_rowid), 
+                    'tenths': tenthsType(scaled),
+                    'tstamp': timestampType(epoch) }
         )
 
 # ============================================================================ #
@@ -773,12 +1079,12 @@ class HistoryStats(object):
         self.__conn  = conn
 
 
-    def generate(self):
-        self.table()
+    def generate(self, without_rowid=False):
+        self.table(without_rowid)
         self.__conn.commit()
 
 
-    def table(self):
+    def table(self, without_rowid=False):
         '''Create the SQLite HistoryStats table'''
         log.info("Creating HistoryStats Table if not exists")
         self.__cursor.executescript(
@@ -793,8 +1099,8 @@ class HistoryStats(object):
             records_committed  INTEGER,
             timestamp          TEXT DEFAULT CURRENT_TIMESTAMP,
             PRIMARY KEY (date_id, time_id, station_id, type_id)
-            );
-            """
+            )%s;
+            """ % rowidClause(without_rowid)
         )
 
 # ============================================================================ #
@@ -809,12 +1115,12 @@ class RealTimeStats(object):
         self.__conn  = conn
 
 
-    def generate(self):
-        self.table()
+    def generate(self, without_rowid=False):
+        self.table(without_rowid)
         self.__conn.commit()
 
 
-    def table(self):
+    def table(self, without_rowid=False):
         '''Create the SQLite RealTimeStats table'''
         log.info("Creating RealTimeStats Table if not exists")
         self.__cursor.executescript(
@@ -831,25 +1137,395 @@ class RealTimeStats(object):
             num_bytes          INTEGER,
             lag                INTEGER,
             PRIMARY KEY (date_id, time_id, station_id, type_id)
+            )%s;
+            """ % rowidClause(without_rowid)
+        )
+
+
+class RealTimeBlocks(object):
+    '''
+    All real time status messages of a station, type and minute,
+    packed into a single BLOB row (see emaproto.encodeStatusBlock).
+    Always an ordinary rowid table, as WITHOUT ROWID does not suit 
+    rows this large.
+    '''
+
+    def __init__(self, conn):
+        '''Create the SQLite RealTimeBlocks Table'''
+        self.__cursor  = conn.cursor()
+        self.__conn  = conn
+
+
+    def generate(self, enabled):
+        if enabled:
+            self.table()
+            self.__conn.commit()
+
+
+    def table(self):
+        '''Create the SQLite RealTimeBlocks table'''
+        log.info("Creating RealTimeBlocks Table if not exists")
+        self.__cursor.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS RealTimeBlocks
+            (
+            date_id            INTEGER NOT NULL REFERENCES Date(date_id), 
+            time_id            INTEGER NOT NULL REFERENCES Time(time_id), 
+            station_id         INTEGER NOT NULL REFERENCES Station(station_id),
+            type_id            INTEGER NOT NULL REFERENCES Type(type_id),
+            num_samples        INTEGER,
+            samples            BLOB,
+            PRIMARY KEY (date_id, time_id, station_id, type_id)
             );
             """
         )
 
 
+# ============================================================================ #
+#                   HOURLY AND DAILY ROLLUPS (AGGREGATED FACTS)
+# ============================================================================ #
+
+# Measurements summarized in the rollup tables
+ROLLUP_MEASURES = ('cal_pressure', 'rain', 'irradiation', 'vis_magnitude',
+                   'temperature', 'rel_humidity', 'dew_point', 'wind_speed')
+
+# Hourly rollup minutes bitmap with every minute of the hour counted
+ALL_MINUTES = (1 << 60) - 1
+
+class Rollups(object):
+    '''
+    Hourly and daily rollups per station of a fact table, with the 
+    number of samples and the minimum, maximum and sum of each measure.
+    Mean values are <measure>_sum / samples.
+    They are kept up to date by an AFTER INSERT trigger on the source
+    table, so rows ignored as duplicates are not counted and late rows
+    are added to their own hour and day. Purges do not affect them.
+    Hourly rows keep a bitmap of the minutes (time_id % 100) already
+    counted, so a row inserted again after being purged is not counted
+    twice.
+    '''
+
+    SOURCE  = None      # Source fact table
+    PREFIX  = None      # Rollup tables name prefix
+    TYPE    = None      # Constant Type table type if the source has none
+
+    def __init__(self, conn):
+        '''Create the SQLite rollup tables'''
+        self.__cursor  = conn.cursor()
+        self.__conn  = conn
+        self.hourly = self.PREFIX + 'Hourly'
+        self.daily  = self.PREFIX + 'Daily'
+
+
+    def generate(self, enabled, without_rowid=False):
+        '''
+        Create the rollup tables and trigger, backfilling them from
+        the source table when enabled. Disabling them drops the trigger
+        but keeps the tables.
+        '''
+        if enabled:
+            self.table(without_rowid)
+            if tableSQL(self.__conn, self.SOURCE) and not self.triggered():
+                self.backfill()
+                self.trigger()
+        else:
+            self.__cursor.execute("DROP TRIGGER IF EXISTS %s_rollup" % 
+                                  self.SOURCE)
+        self.__conn.commit()
+
+
+    def table(self, without_rowid=False):
+        '''Create the SQLite hourly and daily rollup tables'''
+        log.info("Creating %s and %s Tables if not exists", 
+                 self.hourly, self.daily)
+        measures = ''.join(
+            """
+            %(m)s_min  REAL,
+            %(m)s_max  REAL,
+            %(m)s_sum  REAL,""" % { 'm': m } for m in ROLLUP_MEASURES)
+        self.__cursor.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS %(hourly)s
+            (
+            date_id            INTEGER NOT NULL REFERENCES Date(date_id), 
+            time_id            INTEGER NOT NULL REFERENCES Time(time_id), 
+            station_id         INTEGER NOT NULL REFERENCES Station(station_id),
+            type_id            INTEGER NOT NULL REFERENCES Type(type_id),
+            samples            INTEGER,%(measures)s
+            minutes            INTEGER,
+            PRIMARY KEY (date_id, time_id, station_id, type_id)
+            )%(options)s;
+            CREATE TABLE IF NOT EXISTS %(daily)s
+            (
+            date_id            INTEGER NOT NULL REFERENCES Date(date_id), 
+            station_id         INTEGER NOT NULL REFERENCES Station(station_id),
+            type_id            INTEGER NOT NULL REFERENCES Type(type_id),
+            samples            INTEGER,%(measures)s
+            PRIMARY KEY (date_id, station_id, type_id)
+            )%(options)s;
+            """ % { 'hourly': self.hourly, 'daily': self.daily, 
+                    'measures': measures, 
+                    'options': rowidClause(without_rowid) }
+        )
+        if columnType(self.__conn, self.hourly, 'minutes') is None:
+            # Hourly table from schema version 1, backfilled again
+            log.info("Adding minutes column to %s Table", self.hourly)
+            self.__cursor.execute("ALTER TABLE %s ADD COLUMN minutes INTEGER" %
+                                  self.hourly)
+            self.__cursor.execute("DROP TRIGGER IF EXISTS %s_rollup" % 
+                                  self.SOURCE)
+
+    # --------------
+    # Helper methods
+    # --------------
+
+    def measure(self, name, row=''):
+        '''REAL value expression of a source row measurement'''
+        if name in TENTHS_COLUMNS and isScaled(self.__conn, self.SOURCE):
+            return "%s%s / 10.0" % (row, name)
+        return row + name
+
+
+    def typeId(self, row=''):
+        '''type_id expression for a source row'''
+        if self.TYPE is None:
+            return row + 'type_id'
+        return str(self.__conn.execute(
+            "SELECT type_id FROM Type WHERE type = ?", 
+            (self.TYPE,)).fetchone()[0])
+
+
+    def triggered(self):
+        '''True if the source table trigger exists'''
+        return self.__conn.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+            (self.SOURCE + '_rollup',)).fetchone()[0] > 0
+
+
+    def backfill(self):
+        '''
+        Recompute from the source the hours with more source rows than
+        samples counted, as rows may have been inserted while the trigger
+        was dropped. Hours with fewer source rows have been partly purged
+        and are kept. Days are then summed up from the hours.
+        Hours counted without a minutes bitmap get the minutes of their
+        source rows, or every minute if already purged.
+        '''
+        log.info("Backfilling %s and %s from %s", 
+                 self.hourly, self.daily, self.SOURCE)
+        self.__cursor.execute(
+            "INSERT OR REPLACE INTO %s SELECT s.* FROM (SELECT date_id, time_id/100*100 AS time_id, station_id, %s AS type_id, count(*) AS samples, %s, sum(1 << (time_id %% 100)) AS minutes FROM %s GROUP BY 1, 2, 3, 4) AS s LEFT JOIN %s AS h USING (date_id, time_id, station_id, type_id) WHERE h.samples IS NULL OR s.samples > h.samples" % 
+            (self.hourly, self.typeId(), 
+             ', '.join("min(%(m)s), max(%(m)s), total(%(m)s)" % 
+                       { 'm': self.measure(m) } for m in ROLLUP_MEASURES), 
+             self.SOURCE, self.hourly))
+        self.__cursor.execute(
+            "UPDATE %(hourly)s SET minutes = coalesce((SELECT sum(1 << (r.time_id %% 100)) FROM %(source)s AS r WHERE r.date_id = %(hourly)s.date_id AND r.time_id BETWEEN %(hourly)s.time_id AND %(hourly)s.time_id + 59 AND r.station_id = %(hourly)s.station_id AND %(type)s = %(hourly)s.type_id), %(all)d) WHERE minutes IS NULL" % 
+            { 'hourly': self.hourly, 'source': self.SOURCE, 
+              'type': self.typeId('r.'), 'all': ALL_MINUTES })
+        self.__cursor.execute(
+            "INSERT OR REPLACE INTO %s SELECT date_id, station_id, type_id, sum(samples), %s FROM %s GROUP BY 1, 2, 3" % 
+            (self.daily, 
+             ', '.join("min(%s_min), max(%s_max), total(%s_sum)" % (m, m, m)
+                       for m in ROLLUP_MEASURES), 
+             self.hourly))
+
+
+    def trigger(self, schema=None):
+        '''
+        Create the trigger maintaining the rollups. A TEMP trigger is 
+        created for a source table in an attached database schema.
+        '''
+        if schema is None:
+            name, temp, source = self.SOURCE, '', 'main.' + self.SOURCE
+        else:
+            name, temp, source = schema, 'TEMP ', schema + '.' + self.SOURCE
+            self.__cursor.execute("DROP TRIGGER IF EXISTS temp.%s_rollup" % name)
+        update = ', '.join(
+            "%(m)s_min = min(coalesce(%(m)s_min, %(v)s), coalesce(%(v)s, %(m)s_min)), "
+            "%(m)s_max = max(coalesce(%(m)s_max, %(v)s), coalesce(%(v)s, %(m)s_max)), "
+            "%(m)s_sum = coalesce(%(m)s_sum, 0) + coalesce(%(v)s, 0)" % 
+            { 'm': m, 'v': self.measure(m, 'NEW.') }
+            for m in ROLLUP_MEASURES)
+        self.__cursor.execute(
+            """
+            CREATE %(temp)sTRIGGER IF NOT EXISTS %(name)s_rollup 
+            AFTER INSERT ON %(source)s
+            WHEN NOT EXISTS (SELECT 1 FROM %(hourly)s 
+                WHERE date_id = NEW.date_id AND time_id = NEW.time_id/100*100 
+                AND station_id = NEW.station_id AND type_id = %(type)s
+                AND minutes & %(minute)s)
+            BEGIN
+            INSERT OR IGNORE INTO %(hourly)s (date_id, time_id, station_id, type_id, samples, minutes)
+                VALUES (NEW.date_id, NEW.time_id/100*100, NEW.station_id, %(type)s, 0, 0);
+            UPDATE %(hourly)s SET samples = samples + 1, %(update)s,
+                minutes = minutes | %(minute)s
+                WHERE date_id = NEW.date_id AND time_id = NEW.time_id/100*100 
+                AND station_id = NEW.station_id AND type_id = %(type)s;
+            INSERT OR IGNORE INTO %(daily)s (date_id, station_id, type_id, samples)
+                VALUES (NEW.date_id, NEW.station_id, %(type)s, 0);
+            UPDATE %(daily)s SET samples = samples + 1, %(update)s
+                WHERE date_id = NEW.date_id 
+                AND station_id = NEW.station_id AND type_id = %(type)s;
+            END
+            """ % { 'temp': temp, 'name': name, 'source': source, 
+                    'hourly': self.hourly, 'daily': self.daily,
+                    'type': self.typeId('NEW.'), 'update': update,
+                    'minute': '(1 << (NEW.time_id % 100))' }
+        )
+
+
+class RealTimeRollups(Rollups):
+    '''RealTimeSamples hourly and daily rollups'''
+    SOURCE  = 'RealTimeSamples'
+    PREFIX  = 'RealTime'
+
+
+class AveragesRollups(Rollups):
+    '''AveragesHistory hourly and daily rollups, with the Averages type'''
+    SOURCE  = 'AveragesHistory'
+    PREFIX  = 'Averages'
+    TYPE    = 'Averages'
+
+
+def generateDate(connection, info, date_fmt, year_start, year_end, replace):
+    '''
+    Date dimension generation. If only the year range has been extended,
+    just the new years are generated.
+    '''
+    date      = Date(connection, date_fmt, year_start, year_end)
+    signature = date.signature()
+    previous  = info.signature('Date')
+    if not replace and previous == signature:
+        return
+    previous = previous and json.loads(previous)
+    if replace or not previous or previous[0] != date_fmt:
+        date.generate(replace)
+    else:
+        log.info("Extending Date Table from %d-%d to %d-%d", 
+                 previous[1], previous[2], year_start, year_end)
+        if year_start < previous[1]:
+            Date(connection, date_fmt, year_start, previous[1]-1).generate(False)
+        if year_end > previous[2]:
+            Date(connection, date_fmt, previous[2]+1, year_end).generate(False)
+    info.update('Date', signature)
+
+
 def generate(connection, json_dir, date_fmt, year_start, year_end, 
-             replace=False):
-
-    '''Schema Generation. The main function'''
-    Date(connection, date_fmt, year_start, year_end).generate(replace)
-    TimeOfDay(connection).generate(replace)
-    Station(connection,json_dir).generate(replace)
-    MeasurementType(connection).generate(replace)
-    Units(connection,json_dir).generate(replace)
-    MinMaxHistory(connection).generate()
-    RealTimeSamples(connection).generate()
-    AveragesHistory(connection).generate()
-    HistoryStats(connection).generate()
-    RealTimeStats(connection).generate()
+             replace=False, station_indexes=False, without_rowid=False,
+             rollups=False, scaled=False, epoch=False, auto_vacuum=None,
+             blocks=False):
+
+    '''
+    Schema Generation. The main function.
+    Components whose parameters or data did not change since 
+    the last generation are skipped, unless replace is True.
+    without_rowid, scaled and epoch only apply to fact tables not yet created.
+    auto_vacuum only applies to a new database, see autoVacuum().
+    '''
+    if auto_vacuum and not autoVacuum(connection, auto_vacuum):
+        log.warning("auto_vacuum = %s needs a VACUUM (emadbmigrate --vacuum)",
+                    auto_vacuum)
+    info = SchemaInfo(connection)
+    info.generate()
+    generateDate(connection, info, date_fmt, year_start, year_end, replace)
+    for name, dimension in (
+        ('Time',    TimeOfDay(connection)),
+        ('Station', Station(connection,json_dir)),
+        ('Type',    MeasurementType(connection)),
+        ('Units',   Units(connection,json_dir)),
+        ):
+        signature = dimension.signature()
+        if replace or info.signature(name) != signature:
+            dimension.generate(replace)
+            info.update(name, signature)
+    signature = json.dumps([station_indexes, without_rowid, rollups, scaled, 
+                            epoch, blocks])
+    if info.signature('Facts') != signature:
+        for fact in (MinMaxHistory, RealTimeSamples, AveragesHistory):
+            fact(connection).generate(station_indexes, without_rowid, scaled, 
+                                      epoch)
+        HistoryStats(connection).generate(without_rowid)
+        RealTimeStats(connection).generate(without_rowid)
+        RealTimeBlocks(connection).generate(blocks)
+        RealTimeRollups(connection).generate(rollups, without_rowid)
+        AveragesRollups(connection).generate(rollups, without_rowid)
+        for name in MEASUREMENT_TABLES:
+            realView(connection, name)
+        connection.commit()
+        info.update('Facts', signature)
+    info.stamp()
+
+
+# ============================================================================ #
+#                   FACT TABLES WITHOUT ROWID MIGRATION
+# ============================================================================ #
+
+FACT_TABLES = (
+    ('MinMaxHistory',   MinMaxHistory),
+    ('RealTimeSamples', RealTimeSamples),
+    ('AveragesHistory', AveragesHistory),
+    ('HistoryStats',    HistoryStats),
+    ('RealTimeStats',   RealTimeStats),
+)
+
+def tableSQL(connection, name):
+    '''Returns the CREATE TABLE statement of a table or None'''
+    row = connection.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (name,)).fetchone()
+    return row and row[0]
+
+def isWithoutRowid(connection, name):
+    '''True if a table uses the WITHOUT ROWID layout'''
+    sql = tableSQL(connection, name)
+    return sql is not None and 'WITHOUT ROWID' in sql.upper()
+
+def migrate(connection, name, batch=10000):
+    '''
+    Convert a fact table to the WITHOUT ROWID layout in place.
+    The old table is renamed and moved into a new table in batches,
+    each one in its own transaction, so that the EMA DB service may 
+    keep on writing new rows meanwhile and an interrupted migration 
+    can be resumed. Yields the (moved, total) rows after each batch.
+    Station indexes and rollup triggers are dropped and must be 
+    recreated afterwards. Measurements and timestamps encodings are kept.
+    '''
+    cursor = connection.cursor()
+    old    = name + '_rowid'
+    if tableSQL(connection, old) is None:
+        if tableSQL(connection, name) is None or isWithoutRowid(connection, name):
+            return
+        log.info("Renaming %s to %s", name, old)
+        cursor.execute("DROP INDEX IF EXISTS %s_station_idx" % name)
+        cursor.execute("DROP TRIGGER IF EXISTS %s_rollup" % name)
+        cursor.execute("DROP VIEW IF EXISTS %sView" % name)
+        cursor.execute("ALTER TABLE %s RENAME TO %s" % (name, old))
+    if name in MEASUREMENT_TABLES:
+        dict(FACT_TABLES)[name](connection).generate(without_rowid=True, 
+            scaled=isScaled(connection, old), epoch=isEpoch(connection, old))
+        realView(connection, name)
+    else:
+        dict(FACT_TABLES)[name](connection).generate(without_rowid=True)
+    connection.commit()
+    total = connection.execute("SELECT count(*) FROM %s" % old).fetchone()[0]
+    moved = 0
+    while True:
+        last = connection.execute(
+            "SELECT max(rowid) FROM (SELECT rowid FROM %s ORDER BY rowid LIMIT ?)" % old,
+            (batch,)).fetchone()[0]
+        if last is None:
+            break
+        cursor.execute(
+            "INSERT OR IGNORE INTO %s SELECT * FROM %s WHERE rowid <= ?" % (name, old),
+            (last,))
+        cursor.execute("DELETE FROM %s WHERE rowid <= ?" % old, (last,))
+        moved += cursor.rowcount
+        connection.commit()
+        yield moved, total
+    cursor.execute("DROP TABLE %s" % old)
+    connection.commit()
+    log.info("%s converted to WITHOUT ROWID", name)
 
 if __name__ == "__main__":
     from server import logger
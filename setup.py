@@ -69,7 +69,7 @@ if os.name == "posix":
           ('/etc/init.d' ,   ['init.d/emadb']),
           ('/etc/default',   ['default/emadb']),
           ('/etc/emadb',     ['config/config']),
-          ('/usr/local/bin', ['scripts/emadb', 'scripts/emadbload']),
+          ('/usr/local/bin', ['scripts/emadb', 'scripts/emadbload', 'scripts/emadbmigrate']),
           ]
         )
 
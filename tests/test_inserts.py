@@ -0,0 +1,89 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# Fact table inserts must count duplicate rows and invalid rows apart,
+# and go on inserting the rows following an invalid one.
+#
+# Usage (from the top source directory):
+#    python -m unittest discover -s tests
+
+import sys
+import os
+import logging
+import unittest
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(TOP, 'emadb'))
+
+import dbwritter
+
+from test_unitofwork import WriterTestCase, sample
+
+
+class Records(logging.Handler):
+   '''Keeps the messages logged'''
+
+   def __init__(self):
+      logging.Handler.__init__(self)
+      self.messages = []
+
+   def emit(self, record):
+      self.messages.append(record.getMessage())
+
+
+class InsertTestCase(WriterTestCase):
+
+   def setUp(self):
+      WriterTestCase.setUp(self)
+      self.records = Records()
+      dbwritter.log.addHandler(self.records)
+      dbwritter.log.setLevel(logging.INFO)
+
+   def tearDown(self):
+      dbwritter.log.removeHandler(self.records)
+      WriterTestCase.tearDown(self)
+
+   def invalid(self, time_id, type_id=3):
+      '''Row with a NULL units_id'''
+      return sample(time_id, type_id)[0:4] + (None,) + sample(time_id)[5:]
+
+   def testMinMax(self):
+      w = self.writer
+      w.minmax.insert([sample(1200, 1)])
+      rows = [sample(1200, 1), self.invalid(1200, 2), sample(1300, 1)]
+      self.assertEqual(w.minmax.insert(rows), 1)
+      self.assertEqual(self.count('MinMaxHistory'), 2)
+      self.assertTrue("MinMaxHistory: commited rows (1/3), 1 duplicates, "
+                      "1 rejected" in self.records.messages)
+
+   def testRealTime(self):
+      w = self.writer
+      rows = [sample(1200), self.invalid(1201), sample(1200), sample(1202)]
+      self.assertEqual(w.realtime.insert(rows), 2)
+      self.assertEqual(self.count('RealTimeSamples'), 2)
+      self.assertTrue("RealTimeSamples: 1 duplicate rows ignored" in 
+                      self.records.messages)
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,110 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# Rollups must count every sample once, even if it is inserted again
+# after being purged, as a retained MQTT message replayed on restart.
+#
+# Usage (from the top source directory):
+#    python -m unittest discover -s tests
+
+import sys
+import os
+import sqlite3
+import logging
+import unittest
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(TOP, 'emadb'))
+
+import schema
+
+
+def sample(time_id, temperature=10.0):
+   '''RealTimeSamples row in a REAL encoded table'''
+   return ((20150630, time_id, 1, 3, 0) + (1.0,)*9 + (temperature,) + 
+           (1.0,)*5 + ('2015-06-30 %02d:%02d:00' % divmod(time_id, 100),))
+
+
+class RollupsTestCase(unittest.TestCase):
+
+   def setUp(self):
+      logging.getLogger('schema').setLevel(logging.CRITICAL)
+      self.conn = sqlite3.connect(':memory:')
+      schema.generate(self.conn, os.path.join(TOP, 'config'), '%d/%m/%Y', 
+                      2015, 2015, rollups=True)
+
+   def tearDown(self):
+      self.conn.close()
+
+   def insert(self, *rows):
+      self.conn.executemany(
+         "INSERT OR IGNORE INTO RealTimeSamples VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+         rows)
+      self.conn.commit()
+
+   def purge(self):
+      self.conn.execute("DELETE FROM RealTimeSamples")
+      self.conn.commit()
+
+   def hourly(self):
+      return self.conn.execute(
+         "SELECT samples, temperature_sum FROM RealTimeHourly").fetchall()
+
+   def daily(self):
+      return self.conn.execute(
+         "SELECT samples, temperature_sum FROM RealTimeDaily").fetchall()
+
+   def testDuplicate(self):
+      self.insert(sample(1200), sample(1201, 20.0))
+      self.insert(sample(1200))
+      self.assertEqual(self.hourly(), [(2, 30.0)])
+      self.assertEqual(self.daily(), [(2, 30.0)])
+
+   def testInsertAfterPurge(self):
+      self.insert(sample(1200), sample(1201, 20.0))
+      self.purge()
+      self.insert(sample(1201, 20.0))
+      self.assertEqual(self.hourly(), [(2, 30.0)])
+      self.assertEqual(self.daily(), [(2, 30.0)])
+
+   def testLateAfterPurge(self):
+      '''A sample never counted is added even if its hour was purged'''
+      self.insert(sample(1200), sample(1201, 20.0))
+      self.purge()
+      self.insert(sample(1259, 5.0))
+      self.assertEqual(self.hourly(), [(3, 35.0)])
+      self.assertEqual(self.daily(), [(3, 35.0)])
+
+   def testBackfill(self):
+      '''Backfilled hours remember their minutes too'''
+      schema.RealTimeRollups(self.conn).generate(False)
+      self.insert(sample(1200), sample(1201, 20.0))
+      schema.RealTimeRollups(self.conn).generate(True)
+      self.purge()
+      self.insert(sample(1200), sample(1202, 5.0))
+      self.assertEqual(self.hourly(), [(3, 35.0)])
+      self.assertEqual(self.daily(), [(3, 35.0)])
+
+
+if __name__ == '__main__':
+   unittest.main()
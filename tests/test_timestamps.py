@@ -0,0 +1,107 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# The fast timestamp parser must accept exactly what strptime() does.
+#
+# Usage (from the top source directory):
+#    python -m unittest discover -s tests
+
+import sys
+import os
+import calendar
+import datetime
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'emadb'))
+
+import dbwritter
+
+from emaproto import STRFTIME
+
+GOOD = (
+   '(12:34:56 01/02/2015)',
+   '(00:00:00 01/01/2016)',
+   '(23:59:59 31/12/2015)',
+   '(23:59:30 31/12/2015)',      # rounds into the next year
+   '(12:00:00 29/02/2016)',
+   '(1:02:03 01/02/2015)',       # non standard width
+   '(12:34:56  1/02/2015)',      # ditto
+)
+
+BAD = (
+   '(12:34:60 01/02/2015)',
+   '(12:34:61 01/02/2015)',
+   '(12:60:00 01/02/2015)',
+   '(24:00:00 01/02/2015)',
+   '(-1:00:00 01/02/2015)',
+   '(12:-1:00 01/02/2015)',
+   '(12: 1:00 01/02/2015)',
+   '(+1:00:00 01/02/2015)',
+   '(12:34:56 00/02/2015)',
+   '(12:34:56 32/01/2015)',
+   '(12:34:56 29/02/2015)',
+   '(12:34:56 01/13/2015)',
+   '(12:34:56 01/00/2015)',
+   '(12:34:56 -1/02/2015)',
+   '(12:34:56 01/02/+015)',
+   '(12:34:56 01/02/0000)',
+   '(12:34:56 01-02-2015)',
+   '(12:34:56 01/02/2015',
+   '12:34:56 01/02/2015)',
+   '(12:34:56 01/02/2015) ',
+   '(12.34.56 01/02/2015)',
+   '',
+)
+
+
+def reference(tstamp, epoch):
+   '''The strptime() path'''
+   date_id, time_id, ts = dbwritter.roundDateTime(
+      datetime.datetime.strptime(tstamp, STRFTIME))
+   if epoch:
+      return date_id, time_id, calendar.timegm(ts.timetuple())
+   return date_id, time_id, ts.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class TimestampTestCase(unittest.TestCase):
+
+   def testGood(self):
+      for tstamp in GOOD:
+         for epoch in (False, True):
+            self.assertEqual(dbwritter.xtTimestamp(tstamp, epoch), 
+                             reference(tstamp, epoch), tstamp)
+         self.assertEqual(dbwritter.xtDateTime(tstamp), 
+                          dbwritter.roundDateTime(
+                             datetime.datetime.strptime(tstamp, STRFTIME)))
+
+   def testBad(self):
+      for tstamp in BAD:
+         self.assertRaises(ValueError, reference, tstamp, False)
+         self.assertRaises((ValueError, IndexError), 
+                           dbwritter.parseTimestamp, tstamp)
+         self.assertRaises(ValueError, dbwritter.xtTimestamp, tstamp)
+         self.assertRaises(ValueError, dbwritter.xtDateTime, tstamp)
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,279 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# A database locked in the middle of a unit of work must not leave
+# facts without their statistics, nor statistics without their facts,
+# and must discard only the rows of the failing unit. Neither must
+# a message failing to be written discard the rest of an MQTT batch.
+#
+# Usage (from the top source directory):
+#    python -m unittest discover -s tests
+
+import sys
+import os
+import shutil
+import sqlite3
+import datetime
+import tempfile
+import unittest
+import ConfigParser
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(TOP, 'emadb'))
+
+import dbwritter
+import schema
+
+from dbwritter import DATABASE_LOCKED, TYP_MINMAX
+
+
+class FakeServer(object):
+   def addLazy(self, lazy):
+      pass
+
+
+class FailingCursor(object):
+   '''A cursor raising a given error on inserts'''
+
+   def __init__(self, cursor, error):
+      self.cursor = cursor
+      self.error  = error
+
+   def executemany(self, sql, rows):
+      raise self.error
+
+   def __getattr__(self, name):
+      return getattr(self.cursor, name)
+
+
+# Hourly minmax bulk dump and current status message from EMA
+MINMAX = '''(Ce115 603 625 09098 09019 0084 0026 234 54702 +319 476 +156 0000 015 0634 312 m)
+(AX127 064 758 09887 09452 0003 0087 472 48788 +257 921 +058 0000 080 0444 336 M)
+(12:00:00 30/06/2015)'''
+STATUS = '''(AE105 216 965 09654 09940 0030 0051 385 25850 +192 904 +173 0000 092 0856 356 a)
+(12:%02d:00 30/06/2015)'''
+
+
+def sample(time_id, type_id=3, date_id=20150630):
+   '''RealTimeSamples or MinMaxHistory row in a REAL encoded table'''
+   return ((date_id, time_id, 1, type_id, 0) + (1.0,)*15 + 
+           ('%04d-%02d-%02d ' % (date_id // 10000, date_id // 100 % 100, 
+                                 date_id % 100) +
+            '%02d:%02d:00' % divmod(time_id, 100),))
+
+
+class WriterTestCase(unittest.TestCase):
+
+   OPTIONS = ()
+
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.dbfile = os.path.join(self.dir, 'test.db')
+      parser = ConfigParser.ConfigParser()
+      parser.optionxform = str
+      parser.read(os.path.join(TOP, 'config', 'config'))
+      for option, value in (
+         ('dbase_file',     self.dbfile),
+         ('dbase_json_dir', os.path.join(TOP, 'config')),
+         ('dbase_stats',    'yes'),
+         ('dbase_purge',    'no'),
+         ('dbase_log',      'CRITICAL'),
+         ) + self.OPTIONS:
+         parser.set("DBASE", option, value.replace('$DIR', self.dir))
+      self.writer = dbwritter.DBWritter(FakeServer(), parser)
+      self.reader = sqlite3.connect(self.dbfile)
+
+   def tearDown(self):
+      self.reader.close()
+      self.writer.close()
+      shutil.rmtree(self.dir)
+
+   def fail(self, table, error):
+      '''Make a table raise an error on inserts'''
+      name = '_%s__cursor' % table.__class__.__name__
+      setattr(table, name, FailingCursor(getattr(table, name), error))
+
+   def lock(self, table):
+      '''Make a table find the database locked on inserts'''
+      self.fail(table, sqlite3.OperationalError(DATABASE_LOCKED))
+
+   def count(self, table):
+      '''Committed rows, as seen from another connection'''
+      return self.reader.execute(
+         "SELECT count(*) FROM %s" % table).fetchone()[0]
+
+   def stats(self, time_id):
+      return self.writer.rtstats.rows(20150630, time_id, 1, 
+                                      dbwritter.TYP_SAMPLES, 
+                                      '2015-06-30 12:00:00', 0, 1, 100, 0)
+
+
+class UnitOfWorkTestCase(WriterTestCase):
+
+   def testInsertDoesNotRollBack(self):
+      '''A table insert within a unit raises and keeps the transaction'''
+      w = self.writer
+      w.realtime.insert([sample(1200)], commit=False)
+      self.lock(w.rtstats)
+      self.assertRaises(sqlite3.OperationalError, w.rtstats.insert, 
+                        self.stats(1200), commit=False)
+      conn = w._DBWritter__conn
+      self.assertEqual(conn.execute(
+         "SELECT count(*) FROM RealTimeSamples").fetchone()[0], 1)
+      conn.rollback()
+
+   def testLockedStats(self):
+      '''Facts are rolled back with their statistics'''
+      w = self.writer
+      self.lock(w.rtstats)
+      w.writeRealTime([sample(1200), sample(1201)], 
+                      self.stats(1200) + self.stats(1201))
+      self.assertEqual(self.count('RealTimeSamples'), 0)
+      self.assertEqual(self.count('RealTimeStats'), 0)
+      self.assertEqual(w._DBWritter__rtwrites, 0)
+
+   def testLockedHistoryStats(self):
+      w = self.writer
+      self.lock(w.histats)
+      w.writeHistory(w.minmax, TYP_MINMAX, 1, [sample(1200, 1), sample(1200, 2)])
+      self.assertEqual(self.count('MinMaxHistory'), 0)
+      self.assertEqual(self.count('HistoryStats'), 0)
+
+   def testLockedWithinBatch(self):
+      '''A lock discards only the rows of the failing nested unit'''
+      w = self.writer
+      with w.unit:
+         w.writeRealTime([sample(1200)], self.stats(1200))
+         self.lock(w.histats)
+         w.writeHistory(w.minmax, TYP_MINMAX, 1, [sample(1200, 1)])
+         w.writeRealTime([sample(1201)], self.stats(1201))
+      self.assertEqual(self.count('MinMaxHistory'), 0)
+      self.assertEqual(self.count('HistoryStats'), 0)
+      self.assertEqual(self.count('RealTimeSamples'), 2)
+      self.assertEqual(self.count('RealTimeStats'), 2)
+      self.assertEqual(w._DBWritter__rtwrites, 2)
+
+   def testErrorWithinBatch(self):
+      '''Other errors are raised after rolling back the nested unit only'''
+      w = self.writer
+      with w.unit:
+         w.writeRealTime([sample(1200)], self.stats(1200))
+         def fail():
+            with w.unit:
+               w.writeRealTime([sample(1201)], self.stats(1201))
+               raise ValueError("failed")
+         self.assertRaises(ValueError, fail)
+      self.assertEqual(self.count('RealTimeSamples'), 1)
+      self.assertEqual(self.count('RealTimeStats'), 1)
+      self.assertEqual(w._DBWritter__rtwrites, 1)
+
+   def testCommit(self):
+      w = self.writer
+      w.writeRealTime([sample(1200), sample(1201)], 
+                      self.stats(1200) + self.stats(1201))
+      w.writeHistory(w.minmax, TYP_MINMAX, 1, [sample(1200, 1), sample(1200, 2)])
+      self.assertEqual(self.count('RealTimeSamples'), 2)
+      self.assertEqual(self.count('RealTimeStats'), 2)
+      self.assertEqual(self.count('MinMaxHistory'), 2)
+      self.assertEqual(self.count('HistoryStats'), 1)
+      self.assertEqual(w._DBWritter__rtwrites, 2)
+
+
+class ProcessMessagesTestCase(WriterTestCase):
+
+   OPTIONS = (
+      ('dbase_coalesce', 'no'),
+   )
+
+   def batch(self):
+      t1 = datetime.datetime(2015, 6, 30, 12, 0, 1)
+      self.writer.processMessages([
+         ('curstat', 'emapi', STATUS % 0, t1),
+         ('minmax',  'emapi', MINMAX,     None),
+         ('curstat', 'emapi', STATUS % 1, t1),
+      ])
+
+   def testBatch(self):
+      self.batch()
+      self.assertEqual(self.count('MinMaxHistory'), 2)
+      self.assertEqual(self.count('HistoryStats'), 1)
+      self.assertEqual(self.count('RealTimeSamples'), 2)
+      self.assertEqual(self.count('RealTimeStats'), 2)
+
+   def testFailingDump(self):
+      '''A dump failing to be written does not discard the rest of a batch'''
+      self.fail(self.writer.minmax, sqlite3.DatabaseError("disk I/O error"))
+      self.batch()
+      self.assertEqual(self.count('MinMaxHistory'), 0)
+      self.assertEqual(self.count('HistoryStats'), 0)
+      self.assertEqual(self.count('RealTimeSamples'), 2)
+      self.assertEqual(self.count('RealTimeStats'), 2)
+
+   def testLockedDump(self):
+      self.lock(self.writer.histats)
+      self.batch()
+      self.assertEqual(self.count('MinMaxHistory'), 0)
+      self.assertEqual(self.count('HistoryStats'), 0)
+      self.assertEqual(self.count('RealTimeSamples'), 2)
+      self.assertEqual(self.count('RealTimeStats'), 2)
+
+
+class PartitionsTestCase(WriterTestCase):
+
+   OPTIONS = (
+      ('dbase_partitions',    'yes'),
+      ('dbase_partition_dir', os.path.join('$DIR', 'partitions')),
+   )
+
+   def testAttachWithinUnit(self):
+      '''Partitions are attached after the unit, which is not committed early'''
+      w = self.writer
+      yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+      date_id = yesterday.year*10000 + yesterday.month*100 + yesterday.day
+      with w.unit:
+         w.writeHistory(w.minmax, TYP_MINMAX, 1, [sample(1200, 1)])
+         w.writeRealTime([sample(1200, date_id=date_id)], ())
+         self.assertEqual(self.count('MinMaxHistory'), 0)
+         self.assertFalse(date_id in w.partitions.attached())
+      self.assertEqual(self.count('MinMaxHistory'), 1)
+      self.assertEqual(self.count('main.RealTimeSamples'), 1)
+      w.writeRealTime([sample(1201, date_id=date_id)], ())
+      self.assertTrue(date_id in w.partitions.attached())
+      self.assertEqual(self.count('main.RealTimeSamples'), 1)
+      conn = w._DBWritter__conn
+      self.assertEqual(conn.execute(
+         "SELECT count(*) FROM RealTimeSamples").fetchone()[0], 2)
+
+   def testOtherClients(self):
+      '''Other clients see the partitions once attached to their view'''
+      w = self.writer
+      w.writeRealTime([sample(1200, date_id=w.partitions.window()[1])], ())
+      self.assertEqual(self.count('RealTimeSamples'), 0)
+      names = schema.RealTimeSamples(self.reader).attachAll(
+         os.path.join(self.dir, 'partitions'))
+      self.assertEqual(names, sorted(w.partitions.attached().values()))
+      self.assertEqual(self.count('RealTimeSamples'), 1)
+
+
+if __name__ == '__main__':
+   unittest.main()